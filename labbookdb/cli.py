@@ -1,25 +1,81 @@
 __author__ = "Horea Christian"
 
-import argh
+import argparse
+import ast
+import importlib
+import os
+import sys
 
-#the order here is very important, if these modules are called in the wrong order, the declarative base will end up being regenerated and will complain about duplicates along the lines of:
+from . import daemon
+
+#subcommands by their command line name, with the module and function implementing each of them.
+#only the module of the subcommand which is run is imported, since e.g. `labbookdb.report.tracking` pulls in pandas, matplotlib, and the whole selection layer.
+#modules are imported by their absolute names, as mixing import paths can regenerate the declarative base, which then complains about duplicates along the lines of:
 #sqlalchemy.exc.InvalidRequestError: Table 'genotype_associations' is already defined for this MetaData instance.  Specify 'extend_existing=True' to redefine options and columns on an existing Table object.
-#OR
-#ImportError: Gtk3 backend requires pygobject to be installed.
-from labbookdb.report.tracking import further_cages, animals_id, animals_info
-from .db.add import add_generic, append_parameter
-from .db.query import animal_info, cage_info
-
-def main():
-	argh.dispatch_commands([
-		add_generic,
-		animal_info,
-		animals_id,
-		animals_info,
-		append_parameter,
-		cage_info,
-		further_cages,
-		])
+COMMANDS = {
+	"add-bulk": ("labbookdb.db.add", "add_bulk"),
+	"add-indexes": ("labbookdb.db.query", "add_indexes"),
+	"add-generic": ("labbookdb.db.add", "add_generic"),
+	"animal-info": ("labbookdb.db.query", "animal_info"),
+	"animals-id": ("labbookdb.report.tracking", "animals_id"),
+	"animals-info": ("labbookdb.report.tracking", "animals_info"),
+	"append-parameter": ("labbookdb.db.add", "append_parameter"),
+	"cage-info": ("labbookdb.db.query", "cage_info"),
+	"further-cages": ("labbookdb.report.tracking", "further_cages"),
+	"import": ("labbookdb.db.add", "import_entries"),
+	"init": ("labbookdb.db.query", "init_db"),
+	"serve": ("labbookdb.daemon", "serve"),
+	}
+
+def load_command(command):
+	"""Import and return the function implementing a subcommand."""
+
+	module, function = COMMANDS[command]
+	return getattr(importlib.import_module(module), function)
+
+def command_summary(command):
+	"""Return the first line of the docstring of the function implementing a subcommand, read from the module source without importing the module."""
+
+	module, function = COMMANDS[command]
+	module_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), *module.split(".")) + ".py"
+	with open(module_path) as f:
+		tree = ast.parse(f.read())
+	for node in tree.body:
+		if isinstance(node, ast.FunctionDef) and node.name == function:
+			docstring = ast.get_docstring(node) or ""
+			return docstring.split("\n")[0]
+	return ""
+
+def main(argv=None):
+	"""Run the LDB command line interface, importing only the module of the requested subcommand, or forwarding the subcommand to a running LDB daemon (see `labbookdb.daemon`).
+
+	Parameters
+	----------
+	argv : list of str, optional
+		Command line arguments, by default `sys.argv[1:]`.
+	"""
+
+	if argv is None:
+		argv = sys.argv[1:]
+	command = next((i for i in argv if not i.startswith("-")), None)
+	#help is always rendered locally, and argh is only imported if the command is not forwarded to a running daemon
+	if command in daemon.FORWARDED_COMMANDS and not {"-h", "--help"} & set(argv):
+		status = daemon.forward(argv)
+		if status is not None:
+			sys.exit(status)
+	if command in COMMANDS:
+		import argh
+
+		argh.dispatch_commands([load_command(command)], argv=argv)
+		return
+
+	#the overview lists the subcommands without importing any of them
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers(dest="command", metavar="{"+",".join(COMMANDS)+"}")
+	for name in COMMANDS:
+		subparsers.add_parser(name, help=command_summary(name))
+	parser.parse_args(argv)
+	parser.print_help()
 
 if __name__ == '__main__':
 	main()
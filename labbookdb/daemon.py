@@ -0,0 +1,195 @@
+"""Optional LDB daemon, which runs CLI commands in a long-lived process with warm imports, mappers, engines, and caches.
+
+The daemon is started with `LDB serve`, and listens on a Unix domain socket.
+While it is running, the lookup and report commands listed in `FORWARDED_COMMANDS` are forwarded to it by the LDB executable, which otherwise runs them locally.
+"""
+
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import traceback
+
+#the socket path can be changed via the `LDB_SOCKET` environment variable, and forwarding can be disabled by setting it to an empty string
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".labbookdb.sock")
+#commands which only read from the database (and standard input, which is not forwarded); writes always run in the calling process
+FORWARDED_COMMANDS = ("animal-info", "animals-id", "animals-info", "cage-info", "further-cages")
+#environment variables of the calling process which are applied to forwarded commands
+FORWARDED_ENVIRONMENT = ("LDB_PATH",)
+#seconds to wait for the daemon to accept a command, after which the command is run locally; once a command is accepted, its response is awaited without a timeout
+FORWARD_TIMEOUT = 10
+
+def socket_path():
+	"""Return the path of the daemon socket, or an empty string if forwarding is disabled."""
+
+	return os.path.expanduser(os.environ.get("LDB_SOCKET", DEFAULT_SOCKET))
+
+def forward(argv,
+	path=None,
+	):
+	"""Run a command in the LDB daemon, if one is running, and write its output to the standard output and error.
+
+	Parameters
+	----------
+	argv : list of str
+		Command line arguments, starting with the command name.
+	path : str, optional
+		Path of the daemon socket, by default as returned by `socket_path()`.
+
+	Returns
+	-------
+	status : int or None
+		Exit status of the command, or None if no daemon responded on the socket, in which case the command should be run locally.
+
+	Notes
+	-----
+	Only commands which do not write to the database are forwarded, so that commands can safely be run locally if the daemon fails to respond (e.g. if it is not accessible, does not accept the command in time, see `FORWARD_TIMEOUT`, or stops while running the command).
+	Commands accepted by the daemon are not timed out, as running a long report locally while the daemon is still running it would duplicate the work (and any files it saves).
+	"""
+
+	if path is None:
+		path = socket_path()
+	if not path:
+		return None
+	request = {
+		"argv": list(argv),
+		"cwd": os.getcwd(),
+		"environment": {i: os.environ[i] for i in FORWARDED_ENVIRONMENT if i in os.environ},
+		}
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.settimeout(FORWARD_TIMEOUT)
+	with client, client.makefile("rwb") as stream:
+		try:
+			client.connect(path)
+			stream.write((json.dumps(request) + "\n").encode())
+			stream.flush()
+			client.shutdown(socket.SHUT_WR)
+		except OSError:
+			return None
+		client.settimeout(None)
+		try:
+			response = json.loads(stream.readline().decode())
+			stdout, stderr, status = response["stdout"], response["stderr"], response["status"]
+		except (OSError, ValueError, KeyError, TypeError):
+			return None
+	sys.stdout.write(stdout)
+	sys.stderr.write(stderr)
+	return status
+
+def execute(argv,
+	cwd=None,
+	environment={},
+	):
+	"""Run a command in this process, as the LDB executable would, and return its captured output and exit status.
+
+	Parameters
+	----------
+	argv : list of str
+		Command line arguments, starting with the command name.
+	cwd : str, optional
+		Working directory of the calling process, against which relative paths are resolved.
+	environment : dict, optional
+		Environment variables of the calling process (see `FORWARDED_ENVIRONMENT`).
+
+	Returns
+	-------
+	response : dict
+		Dictionary with "stdout", "stderr", and "status" keys.
+
+	Notes
+	-----
+	The working directory, the environment, and the standard streams are process-wide, so that commands are executed one at a time.
+	"""
+
+	import argh
+	from labbookdb.cli import load_command
+
+	stdout = io.StringIO()
+	stderr = io.StringIO()
+	status = 0
+	previous_cwd = os.getcwd()
+	previous_environment = {i: os.environ.get(i) for i in environment}
+	try:
+		if cwd:
+			os.chdir(cwd)
+		os.environ.update(environment)
+		with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+			try:
+				command = next(i for i in argv if not i.startswith("-"))
+				argh.dispatch_commands([load_command(command)], argv=argv, output_file=stdout, errors_file=stderr)
+			except SystemExit as e:
+				if e.code is None:
+					status = 0
+				elif isinstance(e.code, int):
+					status = e.code
+				else:
+					print(e.code, file=sys.stderr)
+					status = 1
+			except Exception:
+				traceback.print_exc()
+				status = 1
+	finally:
+		os.chdir(previous_cwd)
+		for key, value in previous_environment.items():
+			if value is None:
+				os.environ.pop(key, None)
+			else:
+				os.environ[key] = value
+	return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(), "status": status}
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		request = json.loads(self.rfile.readline().decode())
+		response = execute(request["argv"], request.get("cwd"), request.get("environment", {}))
+		self.wfile.write((json.dumps(response) + "\n").encode())
+
+def serve(path=""):
+	"""Run the LDB daemon, which executes forwarded lookup and report commands, until interrupted.
+
+	Parameters
+	----------
+	path : str, optional
+		Path of the socket to listen on, by default the `LDB_SOCKET` environment variable or `~/.labbookdb.sock`.
+		The socket is only accessible to the current user.
+	"""
+
+	import sqlalchemy
+	from labbookdb.cli import load_command
+
+	if not path:
+		path = socket_path() or DEFAULT_SOCKET
+	path = os.path.expanduser(path)
+	if os.path.lexists(path):
+		if not stat.S_ISSOCK(os.lstat(path).st_mode):
+			raise FileExistsError("The daemon socket path {} exists, and is not a socket.".format(path))
+		probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect(path)
+		except ConnectionRefusedError:
+			#left over from a daemon which did not shut down cleanly
+			os.remove(path)
+		else:
+			raise OSError("An LDB daemon is already listening on {}.".format(path))
+		finally:
+			probe.close()
+	#import all command modules (and thereby configure the mappers) before the first request
+	for command in FORWARDED_COMMANDS:
+		load_command(command)
+	sqlalchemy.orm.configure_mappers()
+	previous_umask = os.umask(0o177)
+	try:
+		server = socketserver.UnixStreamServer(path, _RequestHandler)
+	finally:
+		os.umask(previous_umask)
+	print("Serving LDB commands on {}.".format(path), flush=True)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.remove(path)
@@ -2,55 +2,40 @@
 from __future__ import print_function
 
 import argh
+import csv
+import functools
+import itertools
 import json
-import numpy
+import sys
+import time
 
-import pandas as pd
-
-from sqlalchemy import create_engine, literal, update, insert
+from sqlalchemy import literal, update, insert
 from sqlalchemy import inspect
 from os import path
-from sqlalchemy.orm import sessionmaker
 import sqlalchemy
 
 from .common_classes import *
-from .query import ALLOWED_CLASSES
-
-def load_session(db_path):
-	"""Load and return a new SQLalchemy session and engine.
-
-	Parameters
-	----------
-	db_path : str
-		Path to desired database location, can be relative or use tilde to specify the user $HOME.
-
-	Returns
-	-------
-	session : sqlalchemy.orm.session.Session
-		Session instance.
-	engine : sqlalchemy.engine.Engine
-		Engine instance.
-	"""
+from .connection import load_session
+from .query import ALLOWED_CLASSES, IN_LIST_LIMIT, QUERY_CACHE_SIZE, _chunks
 
-	db_path = "sqlite:///" + path.abspath(path.expanduser(db_path))
-	engine = create_engine(db_path, echo=False)
-	#it is very important that `autoflush == False`, otherwise if "treatments" or "measurements" entried precede "external_ids" the latter will insert a null on the animal_id column
-	Session = sessionmaker(bind=engine, autoflush=False)
-	session = Session()
-	Base.metadata.create_all(engine)
-	return session, engine
+RELATED_IDS_KEY = "labbookdb_related_ids"
+#number of entries read and resolved at once by `add_bulk()`, if all entries are committed in one transaction
+BULK_BATCH_SIZE = 1000
 
-def add_to_db(session, engine, myobject):
+def add_to_db(session, engine, myobject, commit=True):
 	"""Add an object to session and return the .id attribute value.
 
 	Parameters
 	----------
 	session : sqlalchemy.orm.session.Session
-		Session instance, as created with labbookdb.db.add.load_session().
+		Session instance, as created with labbookdb.db.connection.load_session().
 	engine : sqlalchemy.engine.Engine
-		Engine instance correponding to the Session instance under session, as created with labbookdb.db.add.load_session().
+		Engine instance correponding to the Session instance under session, as created with labbookdb.db.connection.load_session().
 	myobject : object
 		LabbookDB object with SQLAlchemy-compatible attributes (e.g. as found under labbookdb.db.common_classes).
+	commit : bool, optional
+		Whether to commit the session.
+		If `False`, the session is only flushed (so that the .id attribute value is assigned), and errors are raised rather than printed, so that the caller can roll back the transaction.
 
 	Returns
 	-------
@@ -59,10 +44,13 @@ def add_to_db(session, engine, myobject):
 	"""
 
 	session.add(myobject)
-	try:
-		session.commit()
-	except sqlalchemy.exc.IntegrityError:
-		print("Please make sure this was not a double entry:", myobject)
+	if commit:
+		try:
+			session.commit()
+		except sqlalchemy.exc.IntegrityError:
+			print("Please make sure this was not a double entry:", myobject)
+	else:
+		session.flush()
 	object_id=myobject.id
 	return object_id
 
@@ -77,15 +65,56 @@ def instructions(kind):
 	if kind == "table_identifier":
 		print("Make sure you have entered the filter value correctly. This value is supposed to refer to the id column of another table and needs to be specified as \'table_identifier\'.\'field_by_which_to_filter\'.\'target_value\'")
 
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def parse_selector(parameters):
+	"""Parse a LabbookDB-syntax string into a nested tuple expression.
+
+	Parameters
+	----------
+	parameters : str
+		LabbookDB-syntax string specifying an existing entry.
+
+	Returns
+	-------
+	selector : tuple
+		Tuple of the form `(category, constraints)`, where `constraints` is a tuple of `(field, value)` tuples.
+		Values which are themselves LabbookDB-syntax strings are parsed into selector tuples, and date values are parsed into `datetime.datetime` objects.
+
+	Examples
+	--------
+	>>> from labbookdb.db import add
+	>>> add.parse_selector("Animal:external_ids.AnimalExternalIdentifier:database.ETH/AIC&#&identifier.5701")
+	('Animal', (('external_ids', ('AnimalExternalIdentifier', (('database', 'ETH/AIC'), ('identifier', '5701')))),))
+
+	Notes
+	-----
+	Parsed selectors are memoized, since the same strings recur throughout LabbookDB-style documents.
+	"""
+
+	category, constraints_string = parameters.split(":",1)
+	constraints = []
+	for field_value in constraints_string.split("&&"):
+		field, value = field_value.split(".",1)
+		if "&#&" in value or "&##&" in value:
+			value=value.replace("&#&", "&&")
+			value=value.replace("&##&", "&#&")
+		if ":" in value:
+			value = parse_selector(value)
+		elif field[-4:] == "date": # support for date entry matching (the values have to be passes as string but matched as datetime)
+			value = datetime.datetime(*[int(i) for i in value.split(",")])
+		constraints.append((field, value))
+	return category, tuple(constraints)
+
 def get_related_ids(session, engine, parameters):
 	"""Return the .id attribute value for existing entries matched by a string following the LabbookDB-syntax.
 
 	Parameters
 	----------
 	session : sqlalchemy.orm.session.Session
-		Session instance, as created with labbookdb.db.add.load_session().
+		Session instance, as created with labbookdb.db.connection.load_session().
 	engine : sqlalchemy.engine.Engine
-		Engine instance correponding to the Session instance under session, as created with labbookdb.db.add.load_session().
+		Engine instance correponding to the Session instance under session, as created with labbookdb.db.connection.load_session().
+		Entries are read through the session connection, so that entries flushed but not yet committed are matched as well.
 	parameters : str
 		LabbookDB-syntax string specifying an existing entry.
 
@@ -108,45 +137,73 @@ def get_related_ids(session, engine, parameters):
 	Notes
 	-----
 	Recursivity :
-		This function calls itself recursively in order to get the .id attribute values of related entries (and related entries of related entries, etc.) specified in the LabbookDB-syntax string.
+		This function resolves the .id attribute values of related entries (and related entries of related entries, etc.) specified in the LabbookDB-syntax string recursively.
 		Multiple constraints are separated by double ampersands which may be separated by none or up to two hashtags, to specify at which level the constrains tshould be applied to.
 		One hashtag is removed on each recursion step, and the constraint is only evaluated when there are no hashtags left.
 		"Animal:external_ids.AnimalExternalIdentifier:database.ETH/AIC/cdb&#&identifier.275511" will look for both the database and the identifier attributes in the AnimalExternalIdentifier class, while "Animal:external_ids.AnimalExternalIdentifier:database.ETH/AIC/cdb&#&identifier.275511" will look for the database attribute on the AnimalExternalIdentifier class, and for the identifier attribute on the Animal class.
+	Caching :
+		Resolved selectors (including nested selectors) are cached on the session for the duration of the transaction, so that repeated references to the same entry are queried only once.
+		Cached selectors are dropped if entries of any of the tables they refer to are flushed, and the whole cache is dropped at the end of the transaction.
+		Selectors which match no entry are not cached.
 	"""
 
-	category = parameters.split(":",1)[0]
-	sql_query=session.query(ALLOWED_CLASSES[category])
-	for field_value in parameters.split(":",1)[1].split("&&"):
-		field, value = field_value.split(".",1)
-		if "&#&" in value or "&##&" in value:
-			value=value.replace("&#&", "&&")
-			value=value.replace("&##&", "&#&")
-		if ":" in value:
-			values, objects = get_related_ids(session, engine, value)
+	ids, sql_query, _ = _resolve_selector(session, parse_selector(parameters))
+	return list(ids), sql_query
+
+def _resolve_selector(session, selector):
+	"""Return the .id attribute values, query, and table names for a parsed selector, reading from or populating the session resolution cache."""
+	import pandas as pd
+
+	related_ids = session.info.setdefault(RELATED_IDS_KEY, {})
+	try:
+		return related_ids[selector]
+	except KeyError:
+		pass
+
+	category, constraints = selector
+	category_class = ALLOWED_CLASSES[category]
+	tables = set(table.name for table in inspect(category_class).tables)
+	sql_query=session.query(category_class)
+	for field, value in constraints:
+		if isinstance(value, tuple):
+			values, objects, related_tables = _resolve_selector(session, value)
+			tables.update(related_tables)
 			for value in values:
-				value=int(value) # the value is returned as a numpy object
-				if field[-4:] == "date": # support for date entry matching (the values have to be passes as string but matched as datetime)
-					value = datetime.datetime(*[int(i) for i in value.split(",")])
 				# we are generally looking to match values, but sometimes the parent table does not have an id column, but only a relationship column (e.g. in one to many relationships)
 				try:
-					sql_query = sql_query.filter(getattr(ALLOWED_CLASSES[category], field)==value)
+					sql_query = sql_query.filter(getattr(category_class, field)==value)
 				except sqlalchemy.exc.InvalidRequestError:
-					sql_query = sql_query.filter(getattr(ALLOWED_CLASSES[category], field).contains(*[i for i in objects]))
+					sql_query = sql_query.filter(getattr(category_class, field).contains(*[i for i in objects]))
 		else:
-			if field[-4:] == "date": # support for date entry matching (the values have to be passes as string but matched as datetime)
-				value = datetime.datetime(*[int(i) for i in value.split(",")])
-			sql_query = sql_query.filter(getattr(ALLOWED_CLASSES[category], field)==value)
+			sql_query = sql_query.filter(getattr(category_class, field)==value)
 	mystring = sql_query.with_labels().statement
-	mydf = pd.read_sql_query(mystring,engine)
-	category_tablename = ALLOWED_CLASSES[category].__table__.name
+	mydf = pd.read_sql_query(mystring,session.connection())
+	category_tablename = category_class.__table__.name
 	related_table_ids = mydf[category_tablename+"_id"]
 	ids = list(related_table_ids)
 	ids = [int(i) for i in ids]
 	if ids == []:
 		raise BaseException("No entry was found with a value of \""+str(value)+"\" on the \""+field+"\" column of the \""+category+"\" CATEGORY, in the database.")
-	session.close()
-	engine.dispose()
-	return ids, sql_query
+	related_ids[selector] = ids, sql_query, tables
+	return related_ids[selector]
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_flush")
+def _expire_related_ids(session, flush_context):
+	"""Drop cached selectors which refer to tables with flushed entries."""
+	related_ids = session.info.get(RELATED_IDS_KEY)
+	if not related_ids:
+		return
+	flushed_tables = set()
+	for instance in itertools.chain(session.new, session.dirty, session.deleted):
+		flushed_tables.update(table.name for table in inspect(instance).mapper.tables)
+	for selector in [selector for selector, (_, _, tables) in related_ids.items() if tables & flushed_tables]:
+		del related_ids[selector]
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_transaction_end")
+def _clear_related_ids(session, transaction):
+	"""Drop the selector cache at the end of each transaction (flushes run in subtransactions, which keep it)."""
+	if transaction.parent is None or transaction.nested:
+		session.info.pop(RELATED_IDS_KEY, None)
 
 def append_parameter(db_path, entry_identification, parameters):
 	"""Assigns a value to a given parameter of a given entry.
@@ -201,7 +258,7 @@ def append_parameter(db_path, entry_identification, parameters):
 						set_attribute.append(related_entry)
 	commit_and_close(session, engine)
 
-def add_generic(db_path, parameters, session=None, engine=None):
+def add_generic(db_path, parameters, session=None, engine=None, commit=True):
 	"""Adds new entries based on a LabbookDB-syntax parameter dictionary.
 
 	Parameters
@@ -211,9 +268,13 @@ def add_generic(db_path, parameters, session=None, engine=None):
 	parameters : str or dict
 		A LabbookDB-style dictionary (or JSON interpretable as dictionary), where keys are "CATEGORY" and other strings specifying the attribute names for the object to be created, and values are the class name (for "CATEGORY") and either the values to assign (verbatim: string, int, or float) or LabbookDB-syntax strings specifying a related entry, or a list of LabbookDB-syntax strings specifying related entries, or a list of LabbookDB-style dictionaries specifying new entries to be created and linked.
 	session : sqlalchemy.orm.session.Session, optional
-		Session instance, as created with labbookdb.db.add.load_session().
+		Session instance, as created with labbookdb.db.connection.load_session().
 	engine : sqlalchemy.engine.Engine, optional
-		Engine instance correponding to the Session instance under session, as created with labbookdb.db.add.load_session().
+		Engine instance correponding to the Session instance under session, as created with labbookdb.db.connection.load_session().
+	commit : bool, optional
+		Whether to commit the new entry (and each of the related entries created on-the-fly) to the database.
+		If `False`, entries are only flushed, and committing or rolling back the transaction is left to the caller (see `add_bulk()`).
+		This is only evaluated if the session and engine parameters are passed.
 
 	Returns
 	-------
@@ -226,6 +287,7 @@ def add_generic(db_path, parameters, session=None, engine=None):
 	if not (session and engine) :
 		session, engine = load_session(db_path)
 		close = True
+		commit = True
 	else:
 		close = False
 	if isinstance(parameters, str):
@@ -261,7 +323,7 @@ def add_generic(db_path, parameters, session=None, engine=None):
 			related_entries=[]
 			for related_entry in parameters[key]:
 				if isinstance(related_entry, dict):
-					related_entry, _ = add_generic(db_path, related_entry, session=session, engine=engine)
+					related_entry, _ = add_generic(db_path, related_entry, session=session, engine=engine, commit=commit)
 					related_entries.append(related_entry)
 				elif isinstance(related_entry, str):
 					my_id = get_related_ids(session, engine, related_entry)[0][0]
@@ -276,22 +338,250 @@ def add_generic(db_path, parameters, session=None, engine=None):
 			print("Setting", myobject.__class__.__name__+"'s",key,"attribute to",parameters[key])
 			setattr(myobject, key, parameters[key])
 
-	object_id = add_to_db(session, engine, myobject)
+	object_id = add_to_db(session, engine, myobject, commit=commit)
 	if close:
 		session.close()
-		engine.dispose()
 	return myobject, object_id
 
+def add_bulk(db_path, entries,
+	chunk_size=0,
+	progress=False,
+	):
+	"""Adds new entries based on a sequence of LabbookDB-syntax parameter dictionaries, in a single transaction (or in one transaction per chunk).
+
+	Parameters
+	----------
+	db_path : str
+		Path to database to open, can be relative or use tilde to specify the user $HOME.
+	entries : str or iterable
+		Path to a newline-delimited JSON file containing one LabbookDB-style dictionary per line (`"-"` for the standard input), or an iterable of LabbookDB-style dictionaries (or JSON strings interpretable as dictionaries), formatted as for `add_generic()`.
+	chunk_size : int, optional
+		Number of entries to commit per transaction.
+		If 0, all entries are committed in one transaction, and are read in batches of `BULK_BATCH_SIZE` entries.
+	progress : bool, optional
+		Whether to report the number of entries added and the throughput on the standard error after each chunk.
+
+	Returns
+	-------
+	count : int
+		Number of entries added.
+
+	Notes
+	-----
+	If adding an entry fails, the current transaction is rolled back and the error is raised, so that either all entries of a chunk are added, or none are.
+	Chunks committed before the failing one are kept.
+	The LabbookDB-syntax strings referenced by the entries of a chunk (or batch) are resolved at once (see `resolve_selectors()`) before the entries are added.
+	Entries are read lazily, so that memory use is bounded by the chunk (or batch) size, rather than by the number of entries.
+	"""
+
+	session, engine = load_session(db_path)
+	count = 0
+	committed = 0
+	start = time.time()
+	try:
+		for chunk in _chunks(iter_entries(entries), chunk_size or BULK_BATCH_SIZE):
+			resolve_selectors(session, _selectors(chunk))
+			for parameters in chunk:
+				add_generic(db_path, parameters, session=session, engine=engine, commit=False)
+				count += 1
+			if chunk_size:
+				session.commit()
+				committed = count
+			if progress:
+				elapsed = time.time() - start
+				print("Added {} entries ({:.1f} entries/s).".format(count, count/max(elapsed, 1e-9)), file=sys.stderr)
+		session.commit()
+		committed = count
+	except:
+		session.rollback()
+		print("Rolled back all entries after the first {} entries.".format(committed), file=sys.stderr)
+		raise
+	finally:
+		session.close()
+	return count
+
+@argh.named("import")
+def import_entries(db_path, source,
+	category="",
+	source_format="",
+	chunk_size=1000,
+	):
+	"""Adds new entries from a newline-delimited JSON or CSV file, streaming them in chunks (see `add_bulk()`).
+
+	Parameters
+	----------
+	db_path : str
+		Path to database to open, can be relative or use tilde to specify the user $HOME.
+	source : str
+		Path to the file to import, or `"-"` for the standard input.
+	category : str, optional
+		LabbookDB class (as found in `labbookdb.db.query.ALLOWED_CLASSES`) of the entries to create, for records which do not specify a "CATEGORY" value.
+	source_format : {"", "ndjson", "csv"}, optional
+		Format of the source, by default determined from the file extension (".csv" for CSV, newline-delimited JSON otherwise).
+	chunk_size : int, optional
+		Number of entries to commit per transaction.
+
+	Returns
+	-------
+	count : int
+		Number of entries added.
+
+	Notes
+	-----
+	Columns are mapped onto the attributes of the class of each entry, either by attribute name or by the `Class_attribute` form used in `labbookdb.db.query.get_df()` outputs.
+	Empty CSV cells are skipped, and CSV values are coerced to the type of the corresponding column.
+	CSV cells for relationship attributes may contain a single LabbookDB-syntax string, or a JSON list of LabbookDB-syntax strings or LabbookDB-style dictionaries.
+	"""
+
+	records = read_records(source, source_format)
+	entries = map_records(records, category)
+	return add_bulk(db_path, entries, chunk_size=chunk_size, progress=True)
+
+def read_records(source,
+	source_format="",
+	):
+	"""Yield dictionaries from a newline-delimited JSON or CSV file path (`"-"` for the standard input)."""
+	if not source_format:
+		source_format = "csv" if source.lower().endswith(".csv") else "ndjson"
+	if source_format == "ndjson":
+		for record in iter_entries(source):
+			yield record
+	elif source_format == "csv":
+		if source == "-":
+			for record in csv.DictReader(sys.stdin):
+				yield record
+		else:
+			with open(path.abspath(path.expanduser(source)), newline="") as f:
+				for record in csv.DictReader(f):
+					yield record
+	else:
+		raise ValueError("The source_format value needs to be one of \"ndjson\" or \"csv\", not \"{}\".".format(source_format))
+
+def map_records(records,
+	category="",
+	):
+	"""Yield LabbookDB-style dictionaries from flat records, mapping their keys onto class attributes and coercing string values to the column types."""
+	for record in records:
+		record_category = record.get("CATEGORY") or category
+		if not record_category:
+			raise ValueError("No CATEGORY was specified for the record: {}".format(record))
+		mapper = inspect(ALLOWED_CLASSES[record_category])
+		parameters = {"CATEGORY":record_category}
+		for key, value in record.items():
+			if key == "CATEGORY" or value == "" or value is None:
+				continue
+			if key not in mapper.attrs and key.startswith(record_category+"_"):
+				key = key[len(record_category)+1:]
+			if isinstance(value, str):
+				value = _coerce_attribute(mapper, key, value)
+			parameters[key] = value
+		yield parameters
+
+def _coerce_attribute(mapper, key, value):
+	"""Coerce a string value to the Python type of the mapper attribute under key (leaving LabbookDB-syntax strings and date strings as they are)."""
+	if key not in mapper.attrs:
+		return value
+	attribute = mapper.attrs[key]
+	if isinstance(attribute, sqlalchemy.orm.RelationshipProperty):
+		if value.startswith("[") or value.startswith("{"):
+			value = json.loads(value)
+		if not isinstance(value, list):
+			value = [value]
+		return value
+	if key[-4:] == "date" or ":" in value:
+		return value
+	column_type = attribute.columns[0].type
+	if isinstance(column_type, sqlalchemy.Boolean):
+		return value.lower() in ("1", "true", "yes")
+	if isinstance(column_type, sqlalchemy.Integer):
+		return int(value)
+	if isinstance(column_type, sqlalchemy.Float):
+		return float(value)
+	return value
+
+def iter_entries(entries):
+	"""Yield LabbookDB-style dictionaries from a newline-delimited JSON file path (`"-"` for the standard input), or from an iterable of dictionaries or JSON strings."""
+	if isinstance(entries, str):
+		if entries == "-":
+			for line in sys.stdin:
+				if line.strip():
+					yield json.loads(line)
+		else:
+			with open(path.abspath(path.expanduser(entries))) as f:
+				for line in f:
+					if line.strip():
+						yield json.loads(line)
+	else:
+		for parameters in entries:
+			if isinstance(parameters, str):
+				parameters = json.loads(parameters)
+			yield parameters
+
+def resolve_selectors(session, selectors):
+	"""Resolve LabbookDB-syntax strings in batches, populating the selector cache of the session (see `get_related_ids()`).
+
+	Parameters
+	----------
+	session : sqlalchemy.orm.session.Session
+		Session instance, as created with labbookdb.db.connection.load_session().
+	selectors : iterable of str
+		LabbookDB-syntax strings.
+
+	Notes
+	-----
+	Selectors with a single literal constraint (e.g. "Cage:id.14" or "TreatmentProtocol:code.aFluIV") are grouped by class and attribute, and each group is resolved with one `IN` query.
+	Other selectors, and selectors which match no entry, are left to be resolved (and cached) on their first use.
+	"""
+
+	groups = {}
+	for selector in set(selectors):
+		try:
+			category, constraints = parse_selector(selector)
+		except ValueError:
+			continue
+		if len(constraints) == 1 and isinstance(constraints[0][1], str) and constraints[0][0][-4:] != "date":
+			field, value = constraints[0]
+			groups.setdefault((category, field), set()).add(value)
+
+	related_ids = session.info.setdefault(RELATED_IDS_KEY, {})
+	for (category, field), values in groups.items():
+		category_class = ALLOWED_CLASSES[category]
+		column = getattr(category_class, field)
+		tables = set(table.name for table in inspect(category_class).tables)
+		values = sorted(values)
+		matches = {}
+		for ix in range(0, len(values), IN_LIST_LIMIT):
+			for entry in session.query(category_class).filter(column.in_(values[ix:ix+IN_LIST_LIMIT])):
+				matches.setdefault(str(getattr(entry, field)), []).append(int(entry.id))
+		for value in values:
+			if value in matches:
+				sql_query = session.query(category_class).filter(column==value)
+				related_ids[(category, ((field, value),))] = sorted(matches[value]), sql_query, tables
+
+def _selectors(entries):
+	"""Yield the LabbookDB-syntax strings referenced by LabbookDB-style dictionaries (including nested dictionaries)."""
+	for parameters in entries:
+		for key, value in parameters.items():
+			if key[-3:] == "_id" and isinstance(value, str):
+				yield value
+			elif isinstance(value, list):
+				for related_entry in value:
+					if isinstance(related_entry, str):
+						yield related_entry
+					elif isinstance(related_entry, dict):
+						for selector in _selectors([related_entry]):
+							yield selector
+
 def commit_and_close(session, engine):
-	"""Commit and close session and dispose of engine.
+	"""Commit and close session.
 	Nonfatal for sqlalchemy.exc.IntegrityError with print notification.
 
 	Parameters
 	----------
 	session : sqlalchemy.orm.session.Session, optional
-		Session instance, as created with labbookdb.db.add.load_session().
+		Session instance, as created with labbookdb.db.connection.load_session().
 	engine : sqlalchemy.engine.Engine, optional
-		Engine instance correponding to the Session instance under session, as created with labbookdb.db.add.load_session().
+		Engine instance correponding to the Session instance under session, as created with labbookdb.db.connection.load_session().
 	"""
 
 	try:
@@ -299,4 +589,3 @@ def commit_and_close(session, engine):
 	except sqlalchemy.exc.IntegrityError:
 		print("Please make sure this was not a double entry.")
 	session.close()
-	engine.dispose()
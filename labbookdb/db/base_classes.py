@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy import Column, Integer, String, Sequence, Table, ForeignKey, Float, DateTime, Boolean, ForeignKeyConstraint
+from sqlalchemy import Column, Integer, String, Sequence, Table, ForeignKey, Float, DateTime, Boolean, ForeignKeyConstraint, Index
 from sqlalchemy.orm import validates, backref, relationship
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
@@ -8,15 +8,26 @@ from .utils import *
 
 authors_association = Table('authors_associations', Base.metadata,
 	Column('protocols_id', Integer, ForeignKey('protocols.id')),
-	Column('operators_id', Integer, ForeignKey('operators.id'))
+	Column('operators_id', Integer, ForeignKey('operators.id')),
+	Index('ix_authors_associations_protocols_id_operators_id', 'protocols_id', 'operators_id'),
+	Index('ix_authors_associations_operators_id_protocols_id', 'operators_id', 'protocols_id'),
 	)
 measurements_irregularities_association = Table('measurements_irregularities_association', Base.metadata,
 	Column('measurements_id', Integer, ForeignKey('measurements.id')),
-	Column('irregularities_id', Integer, ForeignKey('irregularities.id'))
+	Column('irregularities_id', Integer, ForeignKey('irregularities.id')),
+	Index('ix_measurements_irregularities_association_measurements_id_irregularities_id', 'measurements_id', 'irregularities_id'),
+	Index('ix_measurements_irregularities_association_irregularities_id_measurements_id', 'irregularities_id', 'measurements_id'),
 	)
 operations_irregularities_association = Table('operations_irregularities_association', Base.metadata,
 	Column('operations_id', Integer, ForeignKey('operations.id')),
-	Column('irregularities_id', Integer, ForeignKey('irregularities.id'))
+	Column('irregularities_id', Integer, ForeignKey('irregularities.id')),
+	Index('ix_operations_irregularities_association_operations_id_irregularities_id', 'operations_id', 'irregularities_id'),
+	Index('ix_operations_irregularities_association_irregularities_id_operations_id', 'irregularities_id', 'operations_id'),
+	)
+#per-table change counters, bumped whenever entries of a table are flushed through the ORM (see `labbookdb.db.query.revision()`)
+revisions = Table('revisions', Base.metadata,
+	Column('table_name', String, primary_key=True),
+	Column('revision', Integer, nullable=False, default=0)
 	)
 
 class Genotype(Base):
@@ -179,14 +190,14 @@ class Measurement(Base):
 	id = Column(Integer, primary_key=True)
 	date = Column(DateTime)
 
-	animal_id = Column(Integer, ForeignKey('animals.id')) # only set in per-animal measurements
-	cage_id = Column(Integer, ForeignKey('cages.id')) # only set in per-cage measurements
+	animal_id = Column(Integer, ForeignKey('animals.id'), index=True) # only set in per-animal measurements
+	cage_id = Column(Integer, ForeignKey('cages.id'), index=True) # only set in per-cage measurements
 
 	irregularities = relationship("Irregularity", secondary=measurements_irregularities_association)
 	operator_id = Column(Integer, ForeignKey('operators.id'))
 	operator = relationship("Operator")
 
-	type = Column(String(50))
+	type = Column(String(50), index=True)
 	__mapper_args__ = {
 		'polymorphic_identity': 'measurement',
 		'polymorphic_on': type
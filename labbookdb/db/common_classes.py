@@ -3,43 +3,63 @@ from .utils import *
 
 cage_stay_association = Table('cage_stay_associations', Base.metadata,
 	Column('cage_stays_id', Integer, ForeignKey('cage_stays.id')),
-	Column('animals_id', Integer, ForeignKey('animals.id'))
+	Column('animals_id', Integer, ForeignKey('animals.id')),
+	Index('ix_cage_stay_associations_cage_stays_id_animals_id', 'cage_stays_id', 'animals_id'),
+	Index('ix_cage_stay_associations_animals_id_cage_stays_id', 'animals_id', 'cage_stays_id'),
 	)
 genotype_association = Table('genotype_associations', Base.metadata,
 	Column('genotypes_id', Integer, ForeignKey('genotypes.id')),
-	Column('animals_id', Integer, ForeignKey('animals.id'))
+	Column('animals_id', Integer, ForeignKey('animals.id')),
+	Index('ix_genotype_associations_genotypes_id_animals_id', 'genotypes_id', 'animals_id'),
+	Index('ix_genotype_associations_animals_id_genotypes_id', 'animals_id', 'genotypes_id'),
 	)
 ingredients_association = Table('ingredients_associations', Base.metadata,
 	Column('solutions_id', Integer, ForeignKey('solutions.id')),
-	Column('ingredients_id', Integer, ForeignKey('ingredients.id'))
+	Column('ingredients_id', Integer, ForeignKey('ingredients.id')),
+	Index('ix_ingredients_associations_solutions_id_ingredients_id', 'solutions_id', 'ingredients_id'),
+	Index('ix_ingredients_associations_ingredients_id_solutions_id', 'ingredients_id', 'solutions_id'),
 	)
 stimulation_events_association = Table('stimulation_events_associations', Base.metadata,
 	Column('stimulation_events_id', Integer, ForeignKey('stimulation_events.id')),
-	Column('stimulation_protocols_id', Integer, ForeignKey('stimulation_protocols.id'))
+	Column('stimulation_protocols_id', Integer, ForeignKey('stimulation_protocols.id')),
+	Index('ix_stimulation_events_associations_stimulation_events_id_stimulation_protocols_id', 'stimulation_events_id', 'stimulation_protocols_id'),
+	Index('ix_stimulation_events_associations_stimulation_protocols_id_stimulation_events_id', 'stimulation_protocols_id', 'stimulation_events_id'),
 	)
 stimulations_association = Table('stimulations_associations', Base.metadata,
 	Column('fmri_measurements_id', Integer, ForeignKey('fmri_measurements.id')),
-	Column('stimulation_protocols_id', Integer, ForeignKey('stimulation_protocols.id'))
+	Column('stimulation_protocols_id', Integer, ForeignKey('stimulation_protocols.id')),
+	Index('ix_stimulations_associations_fmri_measurements_id_stimulation_protocols_id', 'fmri_measurements_id', 'stimulation_protocols_id'),
+	Index('ix_stimulations_associations_stimulation_protocols_id_fmri_measurements_id', 'stimulation_protocols_id', 'fmri_measurements_id'),
 	)
 anesthesia_association = Table('anesthesia_associations', Base.metadata,
 	Column('anesthesia_protocols_id', Integer, ForeignKey('anesthesia_protocols.id')),
-	Column('treatment_protocols_id', Integer, ForeignKey('treatment_protocols.id'))
+	Column('treatment_protocols_id', Integer, ForeignKey('treatment_protocols.id')),
+	Index('ix_anesthesia_associations_anesthesia_protocols_id_treatment_protocols_id', 'anesthesia_protocols_id', 'treatment_protocols_id'),
+	Index('ix_anesthesia_associations_treatment_protocols_id_anesthesia_protocols_id', 'treatment_protocols_id', 'anesthesia_protocols_id'),
 	)
 operation_association = Table('operation_associations', Base.metadata,
 	Column('operations_id', Integer, ForeignKey('operations.id')),
-	Column('protocols_id', Integer, ForeignKey('protocols.id'))
+	Column('protocols_id', Integer, ForeignKey('protocols.id')),
+	Index('ix_operation_associations_operations_id_protocols_id', 'operations_id', 'protocols_id'),
+	Index('ix_operation_associations_protocols_id_operations_id', 'protocols_id', 'operations_id'),
 	)
 oprations_irregularities_association = Table('oprations_irregularities_association', Base.metadata,
 	Column('operations_id', Integer, ForeignKey('operations.id')),
-	Column('irregularities_id', Integer, ForeignKey('irregularities.id'))
+	Column('irregularities_id', Integer, ForeignKey('irregularities.id')),
+	Index('ix_oprations_irregularities_association_operations_id_irregularities_id', 'operations_id', 'irregularities_id'),
+	Index('ix_oprations_irregularities_association_irregularities_id_operations_id', 'irregularities_id', 'operations_id'),
 	)
 treatment_animal_association = Table('treatment_animal_associations', Base.metadata,
 	Column('treatments_id', Integer, ForeignKey('treatments.id')),
-	Column('animals_id', Integer, ForeignKey('animals.id'))
+	Column('animals_id', Integer, ForeignKey('animals.id')),
+	Index('ix_treatment_animal_associations_treatments_id_animals_id', 'treatments_id', 'animals_id'),
+	Index('ix_treatment_animal_associations_animals_id_treatments_id', 'animals_id', 'treatments_id'),
 	)
 treatment_cage_association = Table('treatment_cage_associations', Base.metadata,
 	Column('treatments_id', Integer, ForeignKey('treatments.id')),
-	Column('cages_id', Integer, ForeignKey('cages.id'))
+	Column('cages_id', Integer, ForeignKey('cages.id')),
+	Index('ix_treatment_cage_associations_treatments_id_cages_id', 'treatments_id', 'cages_id'),
+	Index('ix_treatment_cage_associations_cages_id_treatments_id', 'cages_id', 'treatments_id'),
 	)
 
 
@@ -47,10 +67,13 @@ treatment_cage_association = Table('treatment_cage_associations', Base.metadata,
 
 class AnimalExternalIdentifier(Base):
 	__tablename__ = "animal_external_identifiers"
+	__table_args__ = (
+		Index('ix_animal_external_identifiers_database_identifier', 'database', 'identifier'),
+		)
 	id = Column(Integer, primary_key=True)
 	database = Column(String)
 	identifier = Column(String)
-	animal_id = Column(Integer, ForeignKey('animals.id'))
+	animal_id = Column(Integer, ForeignKey('animals.id'), index=True)
 
 class Evaluation(Base):
 	__tablename__ = "evaluations"
@@ -302,7 +325,7 @@ class SucrosePreferenceMeasurement(Measurement):
 class Treatment(Base):
 	__tablename__ = "treatments"
 	id = Column(Integer, primary_key=True)
-	start_date = Column(DateTime) #date of first occurence
+	start_date = Column(DateTime, index=True) #date of first occurence
 	end_date = Column(DateTime) #date of last occurence
 	protocol_id = Column(Integer, ForeignKey('protocols.id'))
 	protocol = relationship('Protocol')
@@ -397,9 +420,9 @@ class CageStay(Base):
 	__tablename__ = "cage_stays"
 	id = Column(Integer, primary_key=True)
 
-	start_date = Column(DateTime) #date of first occurence
+	start_date = Column(DateTime, index=True) #date of first occurence
 
-	cage_id = Column(Integer, ForeignKey('cages.id'))
+	cage_id = Column(Integer, ForeignKey('cages.id'), index=True)
 	cage = relationship("Cage", back_populates="stays")
 
 	single_caged = Column(String) #if singel caged, state reason
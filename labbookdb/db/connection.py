@@ -0,0 +1,250 @@
+"""Connection management for LabbookDB databases.
+
+Engines are created once per database path and connection mode, and shared by all reads and writes of a process.
+Sessions are opened with `load_session()`, or with the `session_scope()` context manager, which also ends the transaction and returns the connection to the engine pool.
+"""
+
+import contextlib
+import functools
+import os
+import threading
+import urllib.parse
+
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+import sqlalchemy
+
+from .common_classes import Base
+
+#connection modes, as accepted by `load_session()` and `session_scope()`
+MODES = ("read-write", "read-only")
+
+#process-wide engines, keyed by the resolved database path and connection profile, so that repeated queries do not pay for engine creation and schema checks
+ENGINES = {}
+#identities of the database files the engines were created for (see `_file_identity()`), by engine key
+_ENGINE_FILES = {}
+_ENGINES_LOCK = threading.RLock()
+
+#factory of the sessions opened by `load_session()`, on which LabbookDB registers its session event listeners (e.g. `labbookdb.db.query._bump_revisions()`), so that they do not apply to other sessions of the process
+#it is very important that `autoflush == False`, otherwise if "treatments" or "measurements" entried precede "external_ids" the latter will insert a null on the animal_id column
+Session = sessionmaker(autoflush=False)
+
+#SQLite pragmas applied to every new connection, by connection profile name (see `create_sqlite_engine()`)
+SQLITE_PROFILES = {
+	#WAL lets readers proceed while a writer commits, and synchronous=NORMAL is safe in WAL mode (a power loss can only roll back the last commits)
+	"read-write": {
+		"journal_mode": "WAL",
+		"synchronous": "NORMAL",
+		"cache_size": -65536,
+		"mmap_size": 268435456,
+		"temp_store": "MEMORY",
+		"foreign_keys": "ON",
+		},
+	#readers leave the journal mode (which is persistent, and can only be changed with a write lock) as it is
+	"read-only": {
+		"cache_size": -65536,
+		"mmap_size": 268435456,
+		"temp_store": "MEMORY",
+		"foreign_keys": "ON",
+		},
+	}
+
+def create_sqlite_engine(db_path,
+	profile="read-write",
+	read_only=False,
+	**kwargs
+	):
+	"""Return a new SQLAlchemy engine for an SQLite database, which applies the pragmas of a connection profile to every new connection.
+
+	Parameters
+	----------
+	db_path : str
+		Path to desired database location, can be relative or use tilde to specify the user $HOME.
+	profile : str or dict, optional
+		Name of a connection profile from `SQLITE_PROFILES`, or a dictionary of SQLite pragma names and values.
+	read_only : bool, optional
+		Whether to open the database file in the SQLite read-only URI mode, in which any write (but not the creation of temporary tables) fails.
+	**kwargs
+		Keyword arguments passed to `sqlalchemy.create_engine()`.
+
+	Returns
+	-------
+	engine : sqlalchemy.engine.Engine
+		Engine instance.
+
+	Notes
+	-----
+	The "read-write" profile switches the database to WAL journal mode, so that report readers and a writer do not block each other.
+	WAL requires all processes accessing the database to be on the same host; for databases shared over a network file system, use a profile without `journal_mode` (and reset it with `PRAGMA journal_mode=DELETE`).
+	"""
+
+	if isinstance(profile, str):
+		profile = SQLITE_PROFILES[profile]
+	db_path = os.path.abspath(os.path.expanduser(db_path))
+	if read_only:
+		url = "sqlite:///file:{}?mode=ro&uri=true".format(urllib.parse.quote(db_path))
+	else:
+		url = "sqlite:///" + db_path
+	engine = sqlalchemy.create_engine(url, **kwargs)
+	sqlalchemy.event.listen(engine, "connect", functools.partial(_set_pragmas, dict(profile)))
+	return engine
+
+def _set_pragmas(pragmas, dbapi_connection, connection_record):
+	cursor = dbapi_connection.cursor()
+	for pragma, value in pragmas.items():
+		cursor.execute("PRAGMA {}={}".format(pragma, value))
+	cursor.close()
+
+def get_engine(db_path,
+	profile="read-write",
+	):
+	"""Return the process-wide SQLAlchemy engine for a database and connection profile, creating it on first use.
+
+	The schema is created (`Base.metadata.create_all()`) only when the first writable engine for the database is created, and engines keep a pool of open connections, which are reused by subsequent calls.
+	Engines with the "read-only" profile open the database file in the SQLite read-only URI mode, and never issue DDL statements, so that reads do not pay for checking the schema of every table.
+	If the database file was replaced (e.g. by copying a database over it and renaming it) since the engine was created, the engines of the database are disposed, and a new engine is created, as pooled connections would otherwise keep reading the replaced file.
+
+	Parameters
+	----------
+	db_path : str
+		Path to desired database location, can be relative or use tilde to specify the user $HOME.
+	profile : str or dict, optional
+		Name of a connection profile from `SQLITE_PROFILES`, or a dictionary of SQLite pragma names and values (see `create_sqlite_engine()`).
+
+	Returns
+	-------
+	engine : sqlalchemy.engine.Engine
+		Engine instance.
+
+	Raises
+	------
+	FileNotFoundError
+		If a read-only engine is requested for a database which does not exist (see `labbookdb.db.query.init_db()`).
+	"""
+
+	db_path = os.path.abspath(os.path.expanduser(db_path))
+	if isinstance(profile, str):
+		key = (db_path, profile)
+	else:
+		key = (db_path, tuple(sorted(profile.items())))
+	with _ENGINES_LOCK:
+		if key in ENGINES and _ENGINE_FILES.get(key) != _file_identity(db_path):
+			dispose_engines(db_path)
+		try:
+			engine = ENGINES[key]
+		except KeyError:
+			read_only = profile == "read-only"
+			if read_only:
+				if not os.path.isfile(db_path):
+					raise FileNotFoundError("No database was found at {}, you can create one with `LDB init {}`.".format(db_path, db_path))
+			elif profile != "read-write":
+				#the schema is only ever created with the read-write profile
+				get_engine(db_path)
+			#SQLite connections are only ever used by one thread at a time, as they are checked out from the pool
+			engine = create_sqlite_engine(db_path, profile, read_only,
+				echo=False,
+				poolclass=QueuePool,
+				connect_args={'check_same_thread': False},
+				)
+			if profile == "read-write":
+				Base.metadata.create_all(engine)
+			ENGINES[key] = engine
+			_ENGINE_FILES[key] = _file_identity(db_path)
+	return engine
+
+def _file_identity(db_path):
+	"""Return the device and inode of a file, which change if the file is replaced, or None if the file does not exist."""
+	try:
+		db_stat = os.stat(db_path)
+	except OSError:
+		return None
+	return db_stat.st_dev, db_stat.st_ino
+
+def dispose_engines(db_path=None):
+	"""Close the pooled connections of process-wide engines and remove the engines from the registry.
+
+	The next query on a disposed database path creates a new engine and re-checks the schema.
+	Engines of a database file which was replaced on disk are disposed by `get_engine()`, this is needed e.g. to release the database before removing it.
+
+	Parameters
+	----------
+	db_path : str, optional
+		Path of the database the engines of which (for all connection profiles) to dispose.
+		If unspecified, all engines are disposed.
+	"""
+
+	with _ENGINES_LOCK:
+		if db_path:
+			db_path = os.path.abspath(os.path.expanduser(db_path))
+			keys = [i for i in ENGINES if i[0] == db_path]
+		else:
+			keys = list(ENGINES.keys())
+		for i in keys:
+			_ENGINE_FILES.pop(i, None)
+			engine = ENGINES.pop(i, None)
+			if engine:
+				engine.dispose()
+
+def load_session(db_path,
+	mode="read-write",
+	):
+	"""Return a new SQLAlchemy session, bound to the process-wide engine for the database and connection mode, and the engine.
+
+	Parameters
+	----------
+	db_path : str
+		Path to desired database location, can be relative or use tilde to specify the user $HOME.
+	mode : {"read-write", "read-only"}, optional
+		Connection mode, which selects the connection profile of the engine (see `SQLITE_PROFILES`).
+
+	Returns
+	-------
+	session : sqlalchemy.orm.session.Session
+		Session instance.
+	engine : sqlalchemy.engine.Engine
+		Engine instance.
+
+	Notes
+	-----
+	Closing the session returns its connection to the engine pool; the engine should not be disposed by callers, use `dispose_engines()` instead.
+	"""
+
+	if mode not in MODES:
+		raise ValueError("The connection mode needs to be one of {}, not '{}'.".format(", ".join(MODES), mode))
+	engine = get_engine(db_path, mode)
+	session = Session(bind=engine)
+	return session, engine
+
+@contextlib.contextmanager
+def session_scope(db_path,
+	mode="read-write",
+	):
+	"""Context manager providing a session for the database, which is committed on exit (read-write mode) or rolled back (read-only mode), and closed.
+
+	If an exception is raised in the context, the session is rolled back and the exception is re-raised.
+
+	Parameters
+	----------
+	db_path : str
+		Path to desired database location, can be relative or use tilde to specify the user $HOME.
+	mode : {"read-write", "read-only"}, optional
+		Connection mode, which selects the connection profile of the engine (see `SQLITE_PROFILES`).
+
+	Examples
+	--------
+	>>> with session_scope("~/syncdata/meta.db", "read-only") as session:
+	...	animal = session.query(Animal).filter(Animal.id == 1).one()
+	"""
+
+	session, _ = load_session(db_path, mode)
+	try:
+		yield session
+		if mode == "read-write":
+			session.commit()
+		else:
+			session.rollback()
+	except:
+		session.rollback()
+		raise
+	finally:
+		session.close()
@@ -1,20 +1,23 @@
 #!/usr/bin/python
 
 import argh
+import contextlib
 import json
 import sys
 
-import pandas as pd
-
 import datetime
+import itertools
 import os
-from copy import deepcopy
-from sqlalchemy.orm import sessionmaker, aliased, contains_eager
+import random
+import types
+from sqlalchemy.orm import aliased, selectinload
 import sqlalchemy
 
 from .common_classes import *
+from .connection import ENGINES, SQLITE_PROFILES, Session, create_sqlite_engine, dispose_engines, get_engine, load_session, session_scope
 
-ALLOWED_CLASSES = {
+#the registry is read-only, so that it can be shared between threads; aliased classes are registered in per-query namespaces instead (see `get_statement()`)
+ALLOWED_CLASSES = types.MappingProxyType({
 	"Animal": Animal,
 	"AnimalExternalIdentifier": AnimalExternalIdentifier,
 	"AnesthesiaProtocol": AnesthesiaProtocol,
@@ -58,9 +61,193 @@ ALLOWED_CLASSES = {
 	"Virus": Virus,
 	"VirusInjectionProtocol": VirusInjectionProtocol,
 	"WeightMeasurement": WeightMeasurement,
-	}
+	})
+
+#`get_df()` statements are cached by their specification, and their compiled forms by statement, so that repeated reports skip both ORM construction and SQL compilation
+QUERY_CACHE_SIZE = 256
+_STATEMENT_CACHE = sqlalchemy.util.LRUCache(QUERY_CACHE_SIZE)
+_COMPILED_CACHE = sqlalchemy.util.LRUCache(QUERY_CACHE_SIZE)
+#filters with more values than this are matched via a temporary table, to keep the SQL short and below the SQLite bound parameter limit
+IN_LIST_LIMIT = 500
+#name of the `revisions` record which holds a random identifier of the database (as its revision value) rather than a table revision, assigned along with the first table revisions
+DATABASE_ID_RECORD = "<database id>"
+
+def add_indexes(db_path):
+	"""Create the indexes declared in the LabbookDB schema which are missing from an existing database (e.g. one created with an older LabbookDB version).
+
+	Parameters
+	----------
+	db_path : string
+		Path to database file.
+
+	Returns
+	-------
+	created : list of str
+		Names of the indexes which were created.
+
+	Notes
+	-----
+	After indexes are created, the SQLite query planner statistics are refreshed via `ANALYZE`.
+	"""
+
+	engine = get_engine(db_path)
+	inspector = sqlalchemy.inspect(engine)
+	table_names = inspector.get_table_names()
+	created = []
+	for table in Base.metadata.sorted_tables:
+		if table.name not in table_names:
+			continue
+		existing = [index["name"] for index in inspector.get_indexes(table.name)]
+		for index in sorted(table.indexes, key=lambda i: i.name):
+			if index.name not in existing:
+				index.create(engine)
+				created.append(index.name)
+	if created:
+		with engine.connect() as connection:
+			connection.execute("ANALYZE")
+	return created
+
+@argh.named("init")
+def init_db(db_path):
+	"""Create a LabbookDB database, or bring the schema of an existing one up to date by adding missing tables and indexes.
+
+	Read-only connections (as used for reports) do not check or create the schema, so that new databases need to be initialized once before they are queried.
+	Writing to a database initializes it as well, once per process.
+
+	Parameters
+	----------
+	db_path : string
+		Path to database file.
+
+	Returns
+	-------
+	created : list of str
+		Names of the indexes which were created on tables which already existed.
+	"""
+
+	get_engine(db_path)
+	return add_indexes(db_path)
+
+def revision(db_path,
+	table_names=[],
+	):
+	"""Return a counter which increases whenever entries of the given tables are changed through the LabbookDB ORM.
+
+	Parameters
+	----------
+	db_path : string
+		Path to database file.
+	table_names : list of str, optional
+		Names of the tables (e.g. "animals", or "cage_stays") to track.
+		If empty, all tables are tracked.
+
+	Returns
+	-------
+	revision : int or None
+		Sum of the revisions of the tables, or None if the database has no revision records (e.g. if it was only ever written by older LabbookDB versions), in which case callers should fall back to e.g. the file modification time.
+
+	Notes
+	-----
+	Revisions are bumped in the transaction which changes the entries, so that a revision is never newer than the committed data.
+	Changes made without the ORM (e.g. with the sqlite3 command line tool) are not tracked.
+	"""
+
+	engine = get_engine(db_path, "read-only")
+	table_records = revisions.c.table_name != DATABASE_ID_RECORD
+	table_revisions = sqlalchemy.select([sqlalchemy.func.sum(revisions.c.revision)]).where(table_records)
+	if table_names:
+		table_revisions = table_revisions.where(revisions.c.table_name.in_(list(table_names)))
+	sql = sqlalchemy.select([
+		sqlalchemy.select([sqlalchemy.func.count()]).select_from(revisions).where(table_records).as_scalar(),
+		table_revisions.as_scalar(),
+		])
+	try:
+		with engine.connect() as connection:
+			records, total = connection.execute(sql).first()
+	except sqlalchemy.exc.OperationalError:
+		return None
+	if not records:
+		return None
+	return total or 0
+
+def database_id(db_path):
+	"""Return a random identifier of the database, which distinguishes it from other databases (e.g. one which was deleted and recreated under the same path) with the same revisions.
+
+	Parameters
+	----------
+	db_path : string
+		Path to database file.
+
+	Returns
+	-------
+	database_id : int or None
+		Identifier of the database, or None if the database has no revision records (see `revision()`).
+	"""
+
+	engine = get_engine(db_path, "read-only")
+	sql = sqlalchemy.select([revisions.c.revision]).where(revisions.c.table_name == DATABASE_ID_RECORD)
+	try:
+		with engine.connect() as connection:
+			return connection.execute(sql).scalar()
+	except sqlalchemy.exc.OperationalError:
+		return None
+
+def get_tables(col_entries,
+	join_entries=[],
+	):
+	"""Return the names of the tables read by a `get_df()` specification.
+
+	Parameters
+	----------
+	col_entries : list
+		Column specification, as documented for `get_df()`.
+	join_entries : list
+		Join specification, as documented for `get_df()`.
+
+	Returns
+	-------
+	table_names : list of str
+		Sorted names of the tables (including association tables and the tables of parent classes) read by the query.
+	"""
+
+	statement, _ = get_statement(
+		tuple(tuple(i) for i in col_entries),
+		tuple(tuple(i) for i in join_entries),
+		("inner",)*len(join_entries),
+		(),
+		)
+	table_names = set()
+	for table in sqlalchemy.sql.util.find_tables(statement, check_columns=True, include_aliases=True, include_joins=True):
+		while not isinstance(table, sqlalchemy.Table) and hasattr(table, "element"):
+			table = table.element
+		if isinstance(table, sqlalchemy.Table):
+			table_names.add(table.name)
+	return sorted(table_names)
+
+@sqlalchemy.event.listens_for(Session, "after_flush")
+def _bump_revisions(session, flush_context):
+	"""Bump the revisions of all tables with entries changed by a flush of a LabbookDB session (see `labbookdb.db.connection.load_session()`), in the flushing transaction."""
+	table_names = set()
+	for instance in itertools.chain(session.new, session.dirty, session.deleted):
+		state = sqlalchemy.inspect(instance)
+		#objects which only had collections changed (e.g. a measurement appended to `Animal.measurements`) do not change their own tables
+		if instance in session.new or instance in session.deleted or session.is_modified(instance, include_collections=False):
+			table_names.update(table.name for table in state.mapper.tables)
+		for relationship in state.mapper.relationships:
+			if relationship.secondary is not None and state.attrs[relationship.key].history.has_changes():
+				table_names.add(relationship.secondary.name)
+	if not table_names:
+		return
+	table_names = sorted(table_names)
+	connection = session.connection()
+	records = [{"table_name":i, "revision":0} for i in table_names]
+	records.append({"table_name":DATABASE_ID_RECORD, "revision":random.getrandbits(62)})
+	connection.execute(revisions.insert().prefix_with("OR IGNORE"), records)
+	connection.execute(revisions.update().where(revisions.c.table_name.in_(table_names)).values(revision=revisions.c.revision+1))
 
 def get_related_id(session, engine, parameters):
+	import pandas as pd
+
 	category = parameters.split(":",1)[0]
 	sql_query=session.query(ALLOWED_CLASSES[category])
 	for field_value in parameters.split(":",1)[1].split("&&"):
@@ -83,95 +270,226 @@ def get_related_id(session, engine, parameters):
 	input_values = list(related_table_ids)
 	if input_values == []:
 		raise BaseException("No entry was found with a value of \""+str(value)+"\" on the \""+field+"\" column of the \""+category+"\" CATEGORY, in the database.")
-	session.close()
-	engine.dispose()
 	return input_values
 
-@argh.arg('-p', '--db_path', type=str)
-@argh.arg('database', default=None, nargs="?")
-def animal_info(identifier, database,
-	db_path=None,
+#relationships loaded along with the entries listed by `animal_info()` and `cage_info()`, and included (as nested dictionaries) in their JSON output
+ANIMAL_INFO_RELATIONSHIPS = {
+	"external_ids": {},
+	"genotypes": {},
+	"cage_stays": {},
+	"observations": {},
+	"operations": {"protocols": {}},
+	"treatments": {"protocol": {}},
+	"measurements": {},
+	}
+CAGE_INFO_RELATIONSHIPS = {
+	"stays": {"animals": {"external_ids": {}}},
+	}
+
+def animal_loader_options():
+	"""Return SQLAlchemy loader options which load all entries needed to format `Animal` objects (see `Animal.__str__()`) in a fixed number of queries, rather than one query per related entry."""
+
+	measurements = sqlalchemy.orm.with_polymorphic(Measurement, "*")
+	return [
+		selectinload(Animal.external_ids),
+		selectinload(Animal.genotypes),
+		selectinload(Animal.cage_stays),
+		selectinload(Animal.observations),
+		selectinload(Animal.operations).selectinload(Operation.protocols),
+		selectinload(Animal.treatments).joinedload(Treatment.protocol),
+		selectinload(Animal.measurements.of_type(measurements)).joinedload(measurements.WeightMeasurement.weight_unit),
+		selectinload(Animal.measurements.of_type(measurements)).selectinload(measurements.FMRIMeasurement.irregularities),
+		selectinload(Animal.measurements.of_type(measurements)).selectinload(measurements.FMRIMeasurement.stimulations),
+		]
+
+def cage_loader_options():
+	"""Return SQLAlchemy loader options which load all entries needed to format `Cage` objects (see `Cage.__str__()`) in a fixed number of queries, rather than one query per related entry."""
+
+	return [
+		selectinload(Cage.stays).selectinload(CageStay.animals).selectinload(Animal.external_ids),
+		]
+
+def object_dict(myobject,
+	relationships={},
 	):
-	"""Return the __str__ attribute of an Animal object query filterd by the id column OR by arguments of the external_id objects.
+	"""Return a JSON-serializable dictionary of the loaded column values of a LabbookDB object, and of the given relationships thereof.
 
 	Parameters
 	----------
+	myobject : object
+		LabbookDB object with SQLAlchemy-compatible attributes (e.g. as found under labbookdb.db.common_classes).
+	relationships : dict, optional
+		Dictionary the keys of which are the names of relationships to include, and the values of which are dictionaries of the same form, giving the relationships to include for the related entries.
+
+	Returns
+	-------
+	info : dict
+		Dictionary of column and relationship names and values, with dates formatted as ISO 8601 strings.
+
+	Notes
+	-----
+	Columns which have not been loaded (e.g. the columns of polymorphic subclasses) are omitted, rather than loaded with further queries.
+	"""
 
-	db_path : string
-	Path to a LabbookDB formatted database.
+	state = sqlalchemy.inspect(myobject)
+	info = {}
+	for column in state.mapper.column_attrs:
+		if column.key in state.unloaded:
+			continue
+		value = getattr(myobject, column.key)
+		if isinstance(value, (datetime.date, datetime.datetime)):
+			value = value.isoformat()
+		info[column.key] = value
+	for key, sub_relationships in relationships.items():
+		related = getattr(myobject, key)
+		if related is None:
+			info[key] = None
+		elif isinstance(related, Base):
+			info[key] = object_dict(related, sub_relationships)
+		else:
+			info[key] = [object_dict(i, sub_relationships) for i in related]
+	return info
+
+def _print_info(objects, relationships, output_format):
+	if output_format == "json":
+		print(json.dumps([object_dict(i, relationships) for i in objects], indent=1))
+	elif output_format == "text":
+		for myobject in objects:
+			print(myobject)
+	else:
+		raise ValueError("The output format needs to be one of \"text\" or \"json\", not \"{}\".".format(output_format))
 
-	identifier : int or string
-	The identifier of the animal
+def _identifier_list(identifiers):
+	if isinstance(identifiers, (str, int)):
+		return [identifiers]
+	return list(identifiers)
 
+def _is_integer(identifier):
+	try:
+		int(identifier)
+	except ValueError:
+		return False
+	return True
+
+@argh.arg('-p', '--db_path', type=str)
+@argh.arg('-d', '--database', type=str)
+@argh.arg('-f', '--output-format', choices=("text", "json"))
+@argh.arg('identifiers', nargs="+")
+def animal_info(identifiers,
+	database=None,
+	db_path=None,
+	output_format="text",
+	):
+	"""Print the animals with the given identifiers, selected by the Animal.id column OR by their external identifiers.
+
+	Parameters
+	----------
+	identifiers : int or string or list
+		The identifier(s) of the animal(s).
+		If `database` is unspecified and the last identifier is not an integer, it is used as the `database` value, as in the `LDB animal-info <identifier> <database>` form.
 	database : string or None, optional
-	If specified gives a constraint on the AnimalExternalIdentifier.database column AND truns the identifier attribute into a constraint on the AnimalExternalIdentifier.identifier column. If unspecified, the identfier argument is used as a constraint on the Animal.id column.
+		If specified gives a constraint on the AnimalExternalIdentifier.database column AND turns the identifiers into constraints on the AnimalExternalIdentifier.identifier column. If unspecified, the identifiers are used as constraints on the Animal.id column, and need to be integers.
+	db_path : string, optional
+		Path to a LabbookDB formatted database, by default the value of the `LDB_PATH` environment variable.
+	output_format : {"text", "json"}, optional
+		Whether to print the animals formatted as text (see `Animal.__str__()`), or as a JSON list of dictionaries (see `object_dict()`).
+
+	Notes
+	-----
+	The animals and all their related entries are loaded in a fixed number of queries (see `animal_loader_options()`), regardless of the number of animals.
+	Animals are printed in the order of the identifiers, and identifiers without a matching animal are reported on the standard error.
 	"""
 
 	if not db_path:
 		db_path = os.environ["LDB_PATH"]
-
-	if database and identifier:
-		session, engine = load_session(db_path)
-		sql_query = session.query(Animal)
-		sql_query = sql_query.join(Animal.external_ids)\
-		.filter(AnimalExternalIdentifier.database == database).filter(AnimalExternalIdentifier.identifier == identifier)\
-		.options(contains_eager('external_ids'))
-		identifier = [i for i in sql_query][0].id
-		session.close()
-		engine.dispose()
-
-	session, engine = load_session(db_path)
-	sql_query = session.query(Animal)
-	sql_query = sql_query.filter(Animal.id == identifier)
-	try:
-		animal = [i.__str__() for i in sql_query][0]
-	except:
-		if database == None:
-			print("No entry was found with {id} in the Animal.id column of the database located at {loc}.".format(id=identifier,loc=db_path))
+	identifiers = _identifier_list(identifiers)
+	if not database and len(identifiers) > 1 and not _is_integer(identifiers[-1]):
+		database = identifiers.pop()
+	if not database:
+		invalid = [i for i in identifiers if not _is_integer(i)]
+		if invalid:
+			raise ValueError("Animal.id values need to be integers, but {} given. Specify the database of external identifiers via `database`.".format(", ".join("\"{}\"".format(i) for i in invalid)))
+
+	with session_scope(db_path, "read-only") as session:
+		if database:
+			animal_ids = {}
+			for chunk in _chunks(identifiers, IN_LIST_LIMIT):
+				sql_query = session.query(AnimalExternalIdentifier.identifier, AnimalExternalIdentifier.animal_id)\
+					.filter(AnimalExternalIdentifier.database == database)\
+					.filter(AnimalExternalIdentifier.identifier.in_([str(i) for i in chunk]))
+				animal_ids.update(sql_query)
+			animal_ids = [animal_ids.get(str(i)) for i in identifiers]
 		else:
-			print("No entry was found with {id} in the AnimalExternalIdentifier.identifier column and {db} in the AnimalExternalIdentifier.database column of the database located at {loc}.".format(id=identifier,db=database,loc=db_path))
-	else:
-		print(animal)
-	session.close()
-	engine.dispose()
+			animal_ids = [int(i) for i in identifiers]
+
+		animals = {}
+		for chunk in _chunks([i for i in animal_ids if i is not None], IN_LIST_LIMIT):
+			sql_query = session.query(Animal).filter(Animal.id.in_(chunk)).options(*animal_loader_options())
+			animals.update((i.id, i) for i in sql_query)
+
+		found = []
+		for identifier, animal_id in zip(identifiers, animal_ids):
+			if animal_id in animals:
+				found.append(animals[animal_id])
+			elif database:
+				print("No entry was found with {id} in the AnimalExternalIdentifier.identifier column and {db} in the AnimalExternalIdentifier.database column of the database located at {loc}.".format(id=identifier,db=database,loc=db_path), file=sys.stderr)
+			else:
+				print("No entry was found with {id} in the Animal.id column of the database located at {loc}.".format(id=identifier,loc=db_path), file=sys.stderr)
+		_print_info(found, ANIMAL_INFO_RELATIONSHIPS, output_format)
 
-def cage_info(db_path, identifier,
+@argh.arg('-f', '--output-format', choices=("text", "json"))
+@argh.arg('identifiers', nargs="+")
+def cage_info(db_path, identifiers,
+	output_format="text",
 	):
-	"""Return the __str__ attribute of an Animal object query filterd by the id column OR by arguments of the external_id objects.
+	"""Print the cages with the given identifiers, selected by the Cage.id column, together with the animals which were housed in them.
 
 	Parameters
 	----------
-
 	db_path : string
-	Path to a LabbookDB formatted database.
-
-	identifier : int or string
-	The identifier of the animal
-
-	database : string or None, optional
-	If specified gives a constraint on the AnimalExternalIdentifier.database colun AND truns the identifier attribute into a constraint on the AnimalExternalIdentifier.identifier column. If unspecified, the identfier argument is used as a constraint on the Animal.id column.
+		Path to a LabbookDB formatted database.
+	identifiers : int or string or list
+		The identifier(s) of the cage(s).
+	output_format : {"text", "json"}, optional
+		Whether to print the cages formatted as text (see `Cage.__str__()`), or as a JSON list of dictionaries (see `object_dict()`).
+
+	Notes
+	-----
+	The cages and all their related entries are loaded in a fixed number of queries (see `cage_loader_options()`), regardless of the number of cages.
+	Cages are printed in the order of the identifiers, and identifiers without a matching cage are reported on the standard error.
 	"""
 
-	session, engine = load_session(db_path)
-	sql_query = session.query(Cage)
-	sql_query = sql_query.filter(Cage.id == identifier)
-	cage = [i.__str__() for i in sql_query][0]
-	try:
-		cage = [i.__str__() for i in sql_query][0]
-	except:
-		print("No entry was found with {id} in the Cage.id column of the database located at {loc}.".format(id=identifier,loc=db_path))
-	else:
-		print(cage)
-	session.close()
-	engine.dispose()
-
-def load_session(db_path):
-	db_path = "sqlite:///" + os.path.expanduser(db_path)
-	engine = sqlalchemy.create_engine(db_path, echo=False)
-	Session = sessionmaker(bind=engine)
-	session = Session()
-	Base.metadata.create_all(engine)
-	return session, engine
+	identifiers = _identifier_list(identifiers)
+
+	with session_scope(db_path, "read-only") as session:
+		cage_ids = []
+		for identifier in identifiers:
+			try:
+				cage_ids.append(int(identifier))
+			except ValueError:
+				cage_ids.append(None)
+
+		cages = {}
+		for chunk in _chunks([i for i in cage_ids if i is not None], IN_LIST_LIMIT):
+			sql_query = session.query(Cage).filter(Cage.id.in_(chunk)).options(*cage_loader_options())
+			cages.update((i.id, i) for i in sql_query)
+
+		found = []
+		for identifier, cage_id in zip(identifiers, cage_ids):
+			if cage_id in cages:
+				found.append(cages[cage_id])
+			else:
+				print("No entry was found with {id} in the Cage.id column of the database located at {loc}.".format(id=identifier,loc=db_path), file=sys.stderr)
+		_print_info(found, CAGE_INFO_RELATIONSHIPS, output_format)
+
+def _chunks(iterable, chunk_size):
+	"""Yield lists of chunk_size consecutive items of an iterable, reading the iterable lazily."""
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator, chunk_size))
+		if not chunk:
+			return
+		yield chunk
 
 def commit_and_close(session, engine):
 	try:
@@ -179,10 +497,11 @@ def commit_and_close(session, engine):
 	except sqlalchemy.exc.IntegrityError:
 		print("Please make sure this was not a double entry.")
 	session.close()
-	engine.dispose()
 
-def add_all_columns(cols, class_name):
-	joinclassobject = ALLOWED_CLASSES[class_name]
+def add_all_columns(cols, class_name,
+	classes=ALLOWED_CLASSES,
+	):
+	joinclassobject = classes[class_name]
 
 	#we need to catch this esception, because for aliased classes a mapper is not directly returned
 	try:
@@ -197,7 +516,9 @@ def add_all_columns(cols, class_name):
 def get_for_protocolize(db_path, class_name, code):
 	"""Return a dataframe containing a specific entry from a given class name, joined with its related tables up to three levels down.
 	"""
-	session, engine = load_session(db_path)
+	import pandas as pd
+
+	session, engine = load_session(db_path, "read-only")
 	cols = []
 	joins = []
 	classobject = ALLOWED_CLASSES[class_name]
@@ -233,7 +554,6 @@ def get_for_protocolize(db_path, class_name, code):
 	mydf = pd.read_sql_query(mystring,engine)
 
 	session.close()
-	engine.dispose()
 	return mydf
 
 def get_df(db_path,
@@ -242,6 +562,7 @@ def get_df(db_path,
 	filters=[],
 	join_entries=[],
 	join_types=[],
+	order_by=[],
 	):
 	"""Return a dataframe from a complex query of a LabbookDB-style database
 
@@ -261,7 +582,10 @@ def get_df(db_path,
 		* 2-tuples give the class to be joined on the first element, and the explicit relationship (attribute of another class) on the second element
 		If any of the elements contains a period, the expression will be evaluated as a class (preceeding the period) attribute (after the period)$
 	filters : list
-		A list of lists giving filters for the query. In each sub-list the first and second elements give the class and attribute to be matched. Every following element specifies a possible value for the class attribute (implemented as inclusive disjunction). If the attribute name ends in "date" the function computes datetime objects from the subsequent strings containing numbers separated by commas.
+		A list of lists giving filters for the query. In each sub-list the first and second elements give the class and attribute to be matched. Every following element specifies a possible value for the class attribute (implemented as inclusive disjunction, via an `IN` clause, or via a join to a temporary table if there are more than `IN_LIST_LIMIT` values). If the attribute name ends in "date" the function computes datetime objects from the subsequent strings containing numbers separated by commas.
+		Values are converted to the Python type of the attribute column (e.g. `Animal.id` values can be given as strings or as numpy integers).
+	order_by : list
+		A list of output column names (e.g. "Animal_id") by which to sort the rows.
 	!!!incomplete documentation
 
 
@@ -290,19 +614,195 @@ def get_df(db_path,
 
 	"""
 
-	session, engine = load_session(db_path)
+	import pandas as pd
+
+	engine, statement, params, filter_tables = prepare_query(db_path, col_entries, default_join, filters, join_entries, join_types, order_by)
+	with engine.connect() as connection:
+		connection = connection.execution_options(compiled_cache=_COMPILED_CACHE)
+		with temporary_filter_tables(connection, filter_tables):
+			df = pd.read_sql_query(statement, connection, params=params)
+
+	return df
+
+def iter_df(db_path,
+	col_entries=[],
+	default_join="inner",
+	filters=[],
+	join_entries=[],
+	join_types=[],
+	order_by=[],
+	chunksize=10000,
+	rows=False,
+	):
+	"""Yield the result of a complex query of a LabbookDB-style database incrementally, as dataframe chunks or as row tuples.
+
+	Arguments
+	---------
+
+	db_path : string
+		Path to database file.
+	col_entries, default_join, filters, join_entries, join_types, order_by
+		Query specification, as documented for `get_df()`.
+	chunksize : int, optional
+		Maximal number of rows per dataframe chunk.
+	rows : bool, optional
+		Whether to yield row tuples rather than dataframe chunks.
+
+	Notes
+	-----
+	Rows are fetched from the database cursor as they are consumed, so that memory use is bounded by the chunk size rather than by the size of the result.
+	Column dtypes are inferred per chunk, so that e.g. a column which is entirely empty in one chunk may be of `object` dtype in that chunk only.
+	To process grouped rows incrementally (see e.g. `labbookdb.report.utilities.iter_collapse_rename()`), sort the rows by the grouping column via `order_by`.
+	"""
+
+	import pandas as pd
+
+	engine, statement, params, filter_tables = prepare_query(db_path, col_entries, default_join, filters, join_entries, join_types, order_by)
+	with engine.connect() as connection:
+		connection = connection.execution_options(compiled_cache=_COMPILED_CACHE)
+		with temporary_filter_tables(connection, filter_tables):
+			if rows:
+				for row in connection.execute(statement, params):
+					yield tuple(row)
+			else:
+				for df in pd.read_sql_query(statement, connection, params=params, chunksize=chunksize):
+					yield df
+
+def prepare_query(db_path, col_entries, default_join, filters, join_entries, join_types, order_by):
+	"""Return the engine, the (cached) statement, the bound parameter values, and the temporary filter tables with their values for a `get_df()` specification."""
+
+	engine = get_engine(db_path, "read-only")
+
+	filter_shapes = []
+	filter_values = []
+	for sub_filter in filters:
+		#filters without values do not constrain the query
+		if sub_filter and sub_filter[2:]:
+			values = sub_filter[2:]
+			if sub_filter[1][-4:] == "date" and isinstance(values[0], str):
+				values = [datetime.datetime(*[int(a) for a in i.split(",")]) for i in values]
+			if len(values) == 1:
+				filter_type = "equal"
+			elif len(values) <= IN_LIST_LIMIT:
+				filter_type = "in"
+			else:
+				filter_type = "table"
+			filter_shapes.append((sub_filter[0], sub_filter[1], filter_type))
+			filter_values.append(values)
+
+	#we need to make sure we don't edit the join_types variable passed to this function
+	join_types = list(join_types)
+	while len(join_types) < len(join_entries):
+		join_types.append(default_join)
+
+	statement, filter_parameters = get_statement(
+		tuple(tuple(i) for i in col_entries),
+		tuple(tuple(i) for i in join_entries),
+		tuple(join_types[:len(join_entries)]),
+		tuple(filter_shapes),
+		tuple(order_by),
+		)
+
+	params = {}
+	filter_tables = []
+	for (name, python_type, table), values in zip(filter_parameters, filter_values):
+		values = [coerce_value(i, python_type) for i in values]
+		if table is not None:
+			filter_tables.append((table, values))
+		elif len(values) == 1:
+			params[name] = values[0]
+		else:
+			params[name] = values
+
+	return engine, statement, params, filter_tables
+
+@contextlib.contextmanager
+def temporary_filter_tables(connection, filter_tables):
+	"""Create and fill the temporary filter tables of a statement on a connection for the duration of the context."""
+	for table, values in filter_tables:
+		table.create(connection)
+		connection.execute(table.insert(), [{"value": i} for i in values])
+	try:
+		yield
+	finally:
+		for table, _ in filter_tables:
+			table.drop(connection)
+
+def coerce_value(value, python_type):
+	"""Convert a filter value to the Python type of the column it is matched against, if possible.
+
+	Parameters
+	----------
+	value : object
+		Filter value, e.g. a string, or a numpy scalar as found in `pandas.DataFrame` columns.
+	python_type : type or None
+		Python type of the column, as given by `column.type.python_type`; values are only converted for `int`, `float`, and `str` columns.
+
+	Returns
+	-------
+	value : object
+		Converted value, or the original value if it cannot be converted.
+		Non-integral numbers are not converted for `int` columns, so that they do not match the integer they would be truncated to.
+	"""
+
+	if value is None or python_type not in (int, float, str):
+		return value
+	try:
+		converted = python_type(value)
+	except (TypeError, ValueError, OverflowError):
+		return value
+	if python_type is int and not isinstance(value, str) and converted != value:
+		return value
+	return converted
+
+def get_statement(col_entries, join_entries, join_types, filter_shapes,
+	order_by=(),
+	):
+	"""Return the (cached) parameterized select statement for a normalized `get_df()` specification.
+
+	Statements are cached by their specification, so that the ORM constructs (columns, aliased classes, and joins) are only built once per specification.
+	Filter values are not part of the specification; they are represented by bound parameters, or by temporary tables which need to be created and filled before the statement is executed.
+
+	Parameters
+	----------
+	col_entries : tuple of tuple
+		Column specification, as documented for `get_df()`.
+	join_entries : tuple of tuple
+		Join specification, as documented for `get_df()`.
+	join_types : tuple of str
+		One join type ("inner" or "outer") per element of `join_entries`.
+	filter_shapes : tuple of tuple
+		Tuples containing the class name, the attribute name, and the filter type ("equal", "in", or "table") for each filter.
+	order_by : tuple of str, optional
+		Output column names by which to sort the rows.
+
+	Returns
+	-------
+	statement : sqlalchemy.sql.expression.Select
+		Select statement with bound parameters for the filter values.
+	filter_parameters : list of tuple
+		Tuples containing the bound parameter name, the Python type of the filtered column (or None if it is not known), and the temporary `sqlalchemy.Table` (or None if the filter uses a bound parameter) for each filter.
+	"""
+
+	key = (col_entries, join_entries, join_types, filter_shapes, order_by)
+	try:
+		return _STATEMENT_CACHE[key]
+	except KeyError:
+		pass
 
+	#aliased classes only exist in the namespace of the query which defines them
+	classes = dict(ALLOWED_CLASSES)
 	cols=[]
 	for col_entry in col_entries:
 		if len(col_entry) == 1:
-			add_all_columns(cols, col_entry[0])
+			add_all_columns(cols, col_entry[0], classes)
 		if len(col_entry) == 2:
-			cols.append(getattr(ALLOWED_CLASSES[col_entry[0]],col_entry[1]).label("{}_{}".format(*col_entry)))
+			cols.append(getattr(classes[col_entry[0]],col_entry[1]).label("{}_{}".format(*col_entry)))
 		if len(col_entry) == 3:
-			aliased_class = aliased(ALLOWED_CLASSES[col_entry[1]])
-			ALLOWED_CLASSES[col_entry[0]+"_"+col_entry[1]] = aliased_class
+			aliased_class = aliased(classes[col_entry[1]])
+			classes[col_entry[0]+"_"+col_entry[1]] = aliased_class
 			if col_entry[2] == "":
-				add_all_columns(cols, col_entry[0]+"_"+col_entry[1])
+				add_all_columns(cols, col_entry[0]+"_"+col_entry[1], classes)
 			else:
 				cols.append(getattr(aliased_class,col_entry[2]).label("{}_{}_{}".format(*col_entry)))
 
@@ -312,38 +812,49 @@ def get_df(db_path,
 		for join_entry_substring in join_entry:
 			if "." in join_entry_substring:
 				class_name, table_name = join_entry_substring.split(".") #if this unpacks >2 values, the user specified strings are malformed
-				join_parameters.append(getattr(ALLOWED_CLASSES[class_name],table_name))
+				join_parameters.append(getattr(classes[class_name],table_name))
 			else:
-				join_parameters.append(ALLOWED_CLASSES[join_entry_substring])
+				join_parameters.append(classes[join_entry_substring])
 		joins.append(join_parameters)
 
-	sql_query = session.query(*cols)
-	#we need to make sure we don't edit the join_types variable passed to this function
-	join_types = deepcopy(join_types)
-	while len(join_types) < len(joins):
-		join_types.append(default_join)
-	for ix, join in enumerate(joins):
-		if join_types[ix] == "inner":
+	sql_query = sqlalchemy.orm.Query(cols)
+	for join_type, join in zip(join_types, joins):
+		if join_type == "inner":
 			sql_query = sql_query.join(*join)
-		elif join_types[ix] == "outer":
+		elif join_type == "outer":
 			sql_query = sql_query.outerjoin(*join)
 
-	for sub_filter in filters:
-		if sub_filter:
-			if sub_filter[1][-4:] == "date" and isinstance(sub_filter[2], str):
-				for ix, i in enumerate(sub_filter[2:]):
-					sub_filter[2+ix] = datetime.datetime(*[int(a) for a in i.split(",")])
-			if len(sub_filter) == 3:
-				sql_query = sql_query.filter(getattr(ALLOWED_CLASSES[sub_filter[0]], sub_filter[1]) == sub_filter[2])
-			else:
-				sql_query = sql_query.filter(sqlalchemy.or_(getattr(ALLOWED_CLASSES[sub_filter[0]], sub_filter[1]) == v for v in sub_filter[2:]))
-
-	mystring = sql_query.statement
-	df = pd.read_sql_query(mystring,engine)
-	session.close()
-	engine.dispose()
-
-	return df
+	filter_parameters = []
+	for ix, (class_name, attribute, filter_type) in enumerate(filter_shapes):
+		column = getattr(classes[class_name], attribute)
+		name = "filter_{}".format(ix)
+		try:
+			python_type = column.type.python_type
+		except NotImplementedError:
+			python_type = None
+		table = None
+		if filter_type == "equal":
+			sql_query = sql_query.filter(column == sqlalchemy.bindparam(name))
+		elif filter_type == "in":
+			sql_query = sql_query.filter(column.in_(sqlalchemy.bindparam(name, expanding=True)))
+		elif filter_type == "table":
+			#every statement gets its own table objects, as the value column needs to have the type of the filtered column
+			table = sqlalchemy.Table("ldb_{}".format(name), sqlalchemy.MetaData(),
+				sqlalchemy.Column("value", column.type),
+				prefixes=["TEMPORARY"],
+				)
+			sql_query = sql_query.filter(column.in_(sqlalchemy.select([table.c.value])))
+		filter_parameters.append((name, python_type, table))
+
+	labels = {col.name:col for col in cols}
+	for label in order_by:
+		try:
+			sql_query = sql_query.order_by(labels[label])
+		except KeyError:
+			raise ValueError("Rows can only be sorted by queried columns, and \"{}\" is not one of: {}.".format(label, ", ".join(labels)))
+
+	_STATEMENT_CACHE[key] = sql_query.statement, filter_parameters
+	return _STATEMENT_CACHE[key]
 
 	#THIS IS KEPT TO REMEMBER WHENCE THE ABOVE AWKWARD ROUTINES CAME AND HOW THE CODE IS SUPPOSED TO LOOK IF TYPED OUT
 	# CageTreatment = aliased(Treatment)
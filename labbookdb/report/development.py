@@ -6,38 +6,15 @@ def animal_multiselect(db_path,
 	genotypes=['eptg'],
 	external_id='',
 	):
-	from labbookdb.report.selection import animals_by_genotype, animal_id, animal_treatments, animal_operations
+	from labbookdb.report.selection import select_animals
 
-	if implant_targets:
-		df_implants = animal_operations(db_path, implant_targets=implant_targets)['Animal_id'].tolist()
-	if virus_targets:
-		df_virus = animal_operations(db_path, virus_targets=virus_targets)['Animal_id'].tolist()
-	if genotypes:
-		df_genotype = animals_by_genotype(db_path, genotypes)['Animal_id'].tolist()
-	if cage_treatments:
-		df_treatments = animal_treatments(db_path, cage_treatments=cage_treatments)['Animal_id'].tolist()
-
-	if external_id:
-		if implant_targets:
-			df_implants = [animal_id(db_path, external_id, i, reverse=True) for i in df_implants]
-		if virus_targets:
-			df_virus = [animal_id(db_path, external_id, i, reverse=True) for i in df_virus]
-		if genotypes:
-			df_genotype = [animal_id(db_path, external_id, i, reverse=True) for i in df_genotype]
-		if cage_treatments:
-			df_treatments = [animal_id(db_path, external_id, i, reverse=True) for i in df_treatments]
-
-	d = []
-	if implant_targets:
-		d.append(df_implants)
-	if virus_targets:
-		d.append(df_virus)
-	if genotypes:
-		d.append(df_genotype)
-	if cage_treatments:
-		d.append(df_treatments)
-	selection = list(set(d[0]).intersection(*d))
-	return selection
+	return select_animals(db_path,
+		implant_targets=implant_targets,
+		virus_targets=virus_targets,
+		genotypes=genotypes,
+		cage_treatments=cage_treatments,
+		external_id=external_id,
+		)
 
 def animal_weights_():
 	import matplotlib.pyplot as mpl
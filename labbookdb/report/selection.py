@@ -1,6 +1,9 @@
-import pandas as pd
+import os
+import sqlalchemy
+from sqlalchemy import and_, event, or_
 from labbookdb.db import query
-from labbookdb.report.utilities import concurrent_cagetreatment
+from labbookdb.db.common_classes import Animal, AnimalExternalIdentifier, Cage, CageStay, Genotype, Operation, OpticFiberImplantProtocol, OrthogonalStereotacticTarget, Protocol, Treatment, VirusInjectionProtocol, cage_stay_association, treatment_cage_association
+from labbookdb.report.utilities import cached_result, cagestay_end_dates, concurrent_cagetreatment, db_state, run_selections
 
 def animal_id(db_path, database, identifier, reverse=False):
 	"""Return the main LabbookDB animal identifier given an external database identifier.
@@ -22,8 +25,118 @@ def animal_id(db_path, database, identifier, reverse=False):
 	-------
 	int
 		LabbookDB animal identifier.
+
+	Notes
+	-----
+
+	To resolve more than one identifier, use `animal_ids()`, which requires only one query.
+	"""
+
+	return animal_ids(db_path, database, [identifier], reverse=reverse)[identifier]
+
+EXTERNAL_ID_TABLES = {}
+
+@event.listens_for(AnimalExternalIdentifier, 'after_insert')
+@event.listens_for(AnimalExternalIdentifier, 'after_update')
+@event.listens_for(AnimalExternalIdentifier, 'after_delete')
+def _invalidate_external_id_tables(mapper, connection, target):
+	EXTERNAL_ID_TABLES.clear()
+
+def external_id_table(db_path, database):
+	"""Return a bidirectional lookup table between LabbookDB `Animal.id` values and `AnimalExternalIdentifier.identifier` values for one external database.
+
+	Parameters
+	----------
+
+	db_path : string
+		Path to the database file to query.
+	database : string
+		Valid `AnimalExternalIdentifier.database` value.
+
+	Returns
+	-------
+	tuple
+		Two dictionaries, mapping string representations of `AnimalExternalIdentifier.identifier` values to lists of `Animal.id` values, and string representations of `Animal.id` values to lists of `AnimalExternalIdentifier.identifier` values.
+
+	Notes
+	-----
+
+	Tables are kept in memory, and are invalidated whenever `AnimalExternalIdentifier` entries are flushed in this process, or the revision of the `animals` or `animal_external_identifiers` tables changes (see `labbookdb.report.utilities.db_state()`).
 	"""
 
+	db_path = os.path.abspath(os.path.expanduser(db_path))
+	state = db_state(db_path, ['animals', 'animal_external_identifiers'])
+	try:
+		table_state, table = EXTERNAL_ID_TABLES[(db_path, database)]
+	except KeyError:
+		table_state = None
+	if table_state != state:
+		df = _external_ids(db_path, database)
+		table = (
+			_matches(df, 'AnimalExternalIdentifier_identifier', 'Animal_id'),
+			_matches(df, 'Animal_id', 'AnimalExternalIdentifier_identifier'),
+			)
+		EXTERNAL_ID_TABLES[(db_path, database)] = (state, table)
+	return table
+
+def animal_ids(db_path, database, identifiers,
+	reverse=False,
+	cache=False,
+	):
+	"""Return the main LabbookDB animal identifiers given external database identifiers (or the reverse), using a single query.
+
+	Parameters
+	----------
+
+	db_path : string
+		Path to the database file to query.
+	database : string
+		Valid `AnimalExternalIdentifier.database` value.
+	identifiers : list
+		Valid `AnimalExternalIdentifier.identifier` values.
+	reverse : bool, optional
+		Whether to reverse the query.
+		A reverse query means that LabbookDB `Animal.id` values are given and `AnimalExternalIdentifier.identifier` values are returned.
+	cache : bool, optional
+		Whether to resolve identifiers from an in-memory lookup table (see `external_id_table()`), rather than querying the database.
+
+	Returns
+	-------
+	dict
+		Dictionary with the values of `identifiers` as keys, and the matching identifiers as values.
+		Identifiers which match no (or more than one) entry are mapped to `'FailedIDQuery'`.
+	"""
+
+	identifiers = list(identifiers)
+	if not identifiers:
+		return {}
+	if cache:
+		matches = external_id_table(db_path, database)[int(reverse)]
+	else:
+		df = _external_ids(db_path, database, identifiers, reverse=reverse)
+		if reverse:
+			matches = _matches(df, 'Animal_id', 'AnimalExternalIdentifier_identifier')
+		else:
+			matches = _matches(df, 'AnimalExternalIdentifier_identifier', 'Animal_id')
+
+	labbookdb_ids = {}
+	for identifier in identifiers:
+		match = matches.get(str(identifier), [])
+		if len(match) == 1:
+			labbookdb_ids[identifier] = match[0]
+		else:
+			labbookdb_ids[identifier] = 'FailedIDQuery'
+	if 'FailedIDQuery' in labbookdb_ids.values():
+		print('This may be happening because the identifier query value you have provided matches no (or more than one) entry.')
+
+	return labbookdb_ids
+
+def _external_ids(db_path, database,
+	identifiers=None,
+	reverse=False,
+	):
+	"""Select a `pandas.DataFrame` object containing LabbookDB animal identifiers and the identifiers of one external database, optionally filtered by either."""
+
 	col_entries=[
 		("Animal","id"),
 		("AnimalExternalIdentifier",),
@@ -33,26 +146,25 @@ def animal_id(db_path, database, identifier, reverse=False):
 		]
 
 	my_filters = []
-	if reverse:
-		my_filter = ["Animal","id",identifier]
-		my_filters.append(my_filter)
-	else:
-		my_filter = ["AnimalExternalIdentifier","identifier",identifier]
+	if identifiers:
+		if reverse:
+			my_filter = ["Animal","id"]
+		else:
+			my_filter = ["AnimalExternalIdentifier","identifier"]
+		my_filter.extend(identifiers)
 		my_filters.append(my_filter)
 	my_filter = ["AnimalExternalIdentifier","database",database]
 	my_filters.append(my_filter)
 
 	df = query.get_df(db_path,col_entries=col_entries, join_entries=join_entries, filters=my_filters)
-	try:
-		if reverse:
-			labbookdb_id = df['AnimalExternalIdentifier_identifier'].item()
-		else:
-			labbookdb_id = df['Animal_id'].item()
-	except ValueError:
-		labbookdb_id = 'FailedIDQuery'
-		print('This may be happening because the identifier query value you have provided is of the wrong type (LabbookDB lookups are type-sensitive).')
+	return df
 
-	return labbookdb_id
+def _matches(df, key, value):
+	"""Return a dictionary mapping string representations of the values of one column of a `pandas.DataFrame` object to lists of the corresponding values of another column."""
+	matches = {}
+	for k, v in zip(df[key].tolist(), df[value].tolist()):
+		matches.setdefault(str(k), []).append(v)
+	return matches
 
 def stimulation_protocol(db_path, code):
 	"""Select a `pandas.DataFrame`object containing all events and associated measurement units for a specific stimulation protocol.
@@ -258,11 +370,120 @@ def animal_operations(db_path,
 	return df
 
 
+def select_animals(db_path,
+	implant_targets=[],
+	virus_targets=[],
+	genotypes=[],
+	cage_treatments=[],
+	external_id='',
+	):
+	"""Return the animals matching all of the given criteria, selected with a single query.
+
+	Parameters
+	----------
+
+	db_path : str
+		Path to a LabbookDB formatted database.
+	implant_targets : list, optional
+		A List of LabbookDB `OrthogonalStereotacticTarget.code` values, one of which animals need to have received an optic fiber implant in (see `animal_operations()`).
+	virus_targets : list, optional
+		A List of LabbookDB `OrthogonalStereotacticTarget.code` values, one of which animals need to have received a virus injection in (see `animal_operations()`).
+	genotypes : list, optional
+		A List of LabbookDB `Genotype.code` values, one of which animals need to have.
+	cage_treatments : list, optional
+		A List of LabbookDB `TreatmentProtocol.code` values, one of which animals need to have received as a cage treatment, while they were housed in the cage (see `animal_treatments()`).
+	external_id : str, optional
+		Valid `AnimalExternalIdentifier.database` value.
+		If specified, the identifiers of the animals in this database are returned instead of `Animal.id` values, with `'FailedIDQuery'` for animals which have no (or more than one) such identifier.
+
+	Returns
+	-------
+	list
+		`Animal.id` values (or external identifiers) of the selected animals, ordered by `Animal.id`.
+
+	Notes
+	-----
+
+	Each criterion is compiled into an `EXISTS` subquery, so that the intersection of the criteria is computed by the database, and the external identifiers are joined in the same query.
+	Unlike filtering `animal_operations()` by both `implant_targets` and `virus_targets`, the implant and the injection may have been performed in different operations.
+	"""
+
+	criteria = []
+	if implant_targets:
+		criteria.append(Animal.operations.any(Operation.protocols.of_type(OpticFiberImplantProtocol).any(
+			OpticFiberImplantProtocol.stereotactic_target.has(OrthogonalStereotacticTarget.code.in_(implant_targets))
+			)))
+	if virus_targets:
+		criteria.append(Animal.operations.any(Operation.protocols.of_type(VirusInjectionProtocol).any(
+			VirusInjectionProtocol.stereotactic_target.has(OrthogonalStereotacticTarget.code.in_(virus_targets))
+			)))
+	if genotypes:
+		criteria.append(Animal.genotypes.any(Genotype.code.in_(genotypes)))
+	if cage_treatments:
+		criteria.append(_concurrent_cage_treatment(cage_treatments))
+
+	with query.session_scope(db_path, "read-only") as session:
+		if external_id:
+			sql_query = session.query(Animal.id, AnimalExternalIdentifier.identifier)\
+				.outerjoin(AnimalExternalIdentifier, and_(AnimalExternalIdentifier.animal_id == Animal.id, AnimalExternalIdentifier.database == external_id))
+		else:
+			sql_query = session.query(Animal.id)
+		rows = sql_query.filter(*criteria).order_by(Animal.id).all()
+
+	if not external_id:
+		return [i for i, in rows]
+	identifiers = {}
+	for animal, identifier in rows:
+		identifiers.setdefault(animal, [])
+		if identifier is not None:
+			identifiers[animal].append(identifier)
+	selection = [i[0] if len(i) == 1 else 'FailedIDQuery' for i in identifiers.values()]
+	if 'FailedIDQuery' in selection:
+		print('This may be happening because the identifier query value you have provided matches no (or more than one) entry.')
+	return selection
+
+def _concurrent_cage_treatment(codes):
+	"""Return an SQL criterion matching animals which received one of the given cage treatments while they were housed in the cage, evaluated as in `labbookdb.report.utilities.concurrent_cagetreatment()`, i.e. for the first (by `Treatment.id`) of the given treatments of the cage."""
+
+	#a cage stay ends with the next cage stay of the same animal, or with the animal's death
+	next_stay = sqlalchemy.orm.aliased(CageStay)
+	next_stay_association = cage_stay_association.alias()
+	stay_end = sqlalchemy.func.coalesce(
+		sqlalchemy.select([sqlalchemy.func.min(next_stay.start_date)])\
+			.where(next_stay.id == next_stay_association.c.cage_stays_id)\
+			.where(next_stay_association.c.animals_id == Animal.id)\
+			.where(next_stay.start_date > CageStay.start_date)\
+			.correlate(Animal, CageStay)\
+			.as_scalar(),
+		Animal.death_date,
+		)
+	#the onset is only checked for the first of the given treatments of the cage, as the dataframe implementation checks the first row of each cage stay
+	first_treatment = sqlalchemy.orm.aliased(Treatment)
+	first_treatment_association = treatment_cage_association.alias()
+	first_treatment_id = sqlalchemy.select([sqlalchemy.func.min(first_treatment.id)])\
+		.where(first_treatment.id == first_treatment_association.c.treatments_id)\
+		.where(first_treatment_association.c.cages_id == Cage.id)\
+		.where(first_treatment.protocol.has(Protocol.code.in_(codes)))\
+		.correlate(Cage)\
+		.as_scalar()
+	#comparisons with missing dates do not exclude a treatment, as in the dataframe implementation
+	treatment_start = Treatment.start_date
+	concurrent = and_(
+		or_(treatment_start > CageStay.start_date, treatment_start == None, CageStay.start_date == None),
+		or_(treatment_start < stay_end, treatment_start == None, stay_end == None),
+		or_(treatment_start < Animal.death_date, treatment_start == None, Animal.death_date == None),
+		)
+	return Animal.cage_stays.any(CageStay.cage.has(Cage.treatments.any(and_(
+		Treatment.id == first_treatment_id,
+		concurrent,
+		))))
+
 def animal_treatments(db_path,
 	animal_ids=[],
 	animal_treatments=[],
 	cage_treatments=[],
 	conjunctive=True,
+	concurrent=False,
 	):
 	"""Select a dataframe of animals and all treatments including animal-level or cage-level treatments.
 
@@ -286,6 +507,10 @@ def animal_treatments(db_path,
 	conjunctive : bool, optional
 		Whether both `cage_treatments` and `animal_treatments` need to be satisfied (statements within each list are always disjunctive).
 
+	concurrent : bool, optional
+		Whether to select the cage stays (needed to check the cage treatment onsets) concurrently with the treatments, rather than for the animals in the selected treatments afterwards (see `labbookdb.report.utilities.run_selections()`).
+		The cage stays are then selected for all animals (or for the animals in `animal_ids`), which is slower for narrow treatment filters, but independent of the treatment selection.
+
 	Notes
 	-----
 
@@ -324,13 +549,20 @@ def animal_treatments(db_path,
 		my_filter.extend(cage_treatments)
 	filters.append(my_filter)
 
-	df = query.get_df(db_path, col_entries=col_entries, join_entries=join_entries, filters=filters, default_join=join_type)
-
 	# Generally dataframe operations should be performed in `labbookdb.report.tracking`, however, if animals are selected by cage treatment, we need to determine which animals actually received the treatment.
 	# The following is therefore a selection issue.
-	cage_treatment_columns = ['Cage_Treatment_id','Cage_Treatment_end_date','Cage_Treatment_start_date','Cage_TreatmentProtocol_code','Cage_Treatment_protocol_id']
-	animals = list(df["Animal_id"].unique())
-	cage_stays = cage_periods(db_path, animal_filter=animals)
+	if concurrent:
+		# Cage stays of animals not in the treatments dataframe are not matched by `concurrent_cagetreatment()`, so the cage stays can be selected independently.
+		selections = run_selections({
+			'treatments': lambda: query.get_df(db_path, col_entries=col_entries, join_entries=join_entries, filters=filters, default_join=join_type),
+			'cage_stays': lambda: cage_periods(db_path, animal_filter=animal_ids),
+			}, concurrent=True)
+		df = selections['treatments']
+		cage_stays = selections['cage_stays']
+	else:
+		df = query.get_df(db_path, col_entries=col_entries, join_entries=join_entries, filters=filters, default_join=join_type)
+		animals = list(df["Animal_id"].unique())
+		cage_stays = cage_periods(db_path, animal_filter=animals)
 	df = concurrent_cagetreatment(df, cage_stays)
 
 	# The concurrent cage treatment function cannot delete the entire entry for animals which have only one entry in the dataframe.
@@ -400,7 +632,6 @@ def by_animals(db_path, select, animals):
 	else:
 		raise ValueError("The value for select needs to be one of {}".format(accepted_select_values))
 
-	animals = [str(i) for i in animals] #for some reason the Animal.id values need to be string :-/
 	my_filter = ["Animal","id"]
 	my_filter.extend(animals)
 
@@ -488,17 +719,7 @@ def cage_periods(db_path,
 	Operations on `pandas.DataFrame` objects should be performed in `labbookdb.report.tracking`, however, the cagestay end date is not explicitly recordes, so to select it or select animals by it, we calculate it here.
 	"""
 	df = parameterized(db_path, animal_filter=animal_filter, cage_filter=cage_filter, data_type='cage list')
-	df['CageStay_end_date'] = ''
-	for subject in df['Animal_id'].unique():
-		for start_date in df[df['Animal_id']==subject]['CageStay_start_date'].tolist():
-			possible_end_dates = df[(df['Animal_id']==subject)&(df['CageStay_start_date']>start_date)]['CageStay_start_date'].tolist()
-			try:
-				end_date = min(possible_end_dates)
-			except ValueError:
-				end_date = None
-			if not end_date:
-				end_date = df[df['Animal_id']==subject]['Animal_death_date'].tolist()[0]
-			df.loc[(df['Animal_id']==subject)&(df['CageStay_start_date']==start_date),'CageStay_end_date'] = end_date
+	df['CageStay_end_date'] = cagestay_end_dates(df)
 	return df
 
 def timetable(db_path, filters,
@@ -557,6 +778,7 @@ def parameterized(db_path, data_type,
 	animal_filter=[],
 	cage_filter=[],
 	treatment_start_dates=[],
+	cache=False,
 	):
 	"""Select dataframe from a LabbookDB style database.
 
@@ -572,6 +794,8 @@ def parameterized(db_path, data_type,
 	treatment_start_dates : list, optional
 		A list containing the treatment start date or dates by which to filter the cages for the sucrose preference measurements.
 		Items should be strings in datetime format, e.g. "2016,4,25,19,30".
+	cache : bool, optional
+		Whether to load the result from (or save it to) an on-disk cache next to the database file, which is invalidated by any change to the tables the result is selected from (see `labbookdb.report.utilities.cached_result()`).
 	"""
 
 	default_join = "inner"
@@ -616,8 +840,7 @@ def parameterized(db_path, data_type,
 			]
 		if animal_filter:
 			my_filter = ['Animal','id']
-			# for some reason this needs to be str
-			my_filter.extend([str(i) for i in animal_filter])
+			my_filter.extend(animal_filter)
 	elif data_type == "animals measurements":
 		col_entries=[
 			("Animal","id"),
@@ -641,8 +864,7 @@ def parameterized(db_path, data_type,
 			]
 		if animal_filter:
 			my_filter = ['Animal','id']
-			# for some reason this needs to be str
-			my_filter.extend([str(i) for i in animal_filter])
+			my_filter.extend(animal_filter)
 	elif data_type == "animals weights":
 		col_entries=[
 			("Animal","id"),
@@ -686,14 +908,17 @@ def parameterized(db_path, data_type,
 
 	if animal_filter:
 		my_filter = ['Animal','id']
-		# for some reason this needs to be str
-		my_filter.extend([str(i) for i in animal_filter])
+		my_filter.extend(animal_filter)
 	if cage_filter:
 		my_filter = ['Cage','id']
-		# for some reason this needs to be str
-		my_filter.extend([str(i) for i in cage_filter])
+		my_filter.extend(cage_filter)
 	if treatment_start_dates:
 		my_filter = ["Treatment","start_date"]
 		my_filter.extend(treatment_start_dates)
-	df = query.get_df(db_path,col_entries=col_entries, join_entries=join_entries, filters=[my_filter], default_join=default_join)
+	if cache:
+		key = ['get_df', col_entries, join_entries, [my_filter], default_join]
+		table_names = query.get_tables(col_entries, join_entries)
+		df = cached_result(db_path, key, lambda: query.get_df(db_path,col_entries=col_entries, join_entries=join_entries, filters=[my_filter], default_join=default_join), table_names=table_names)
+	else:
+		df = query.get_df(db_path,col_entries=col_entries, join_entries=join_entries, filters=[my_filter], default_join=default_join)
 	return df
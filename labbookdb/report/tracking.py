@@ -43,6 +43,8 @@ def animals_info(db_path,
 	save_as=None,
 	functional_scan_responders=True,
 	treatments=True,
+	cache=False,
+	concurrent=False,
 	):
 	"""
 	Extract list of animal (database and external) IDs and their death dates and genotypes, and either print it to screen or save it as an HTML file.
@@ -62,36 +64,54 @@ def animals_info(db_path,
 	treatments : bool, optional
 		Whether to create a and list columns tracking what animal-based and cage-based treatements the animal was subjected to.
 
+	cache : bool, optional
+		Whether to load the selections from an on-disk cache next to the database file, which is invalidated by any change to the database.
+
+	concurrent : bool, optional
+		Whether to run the independent selections (animal info, functional scans, irregularities, and treatments) concurrently, each over its own database connection.
+
 	"""
 
-	df = selection.parameterized(db_path, "animals info")
+	selections = {'info': lambda: selection.parameterized(db_path, "animals info", cache=cache)}
+	if functional_scan_responders:
+		selections['measurements'] = lambda: selection.parameterized(db_path, "animals measurements", cache=cache)
+		selections['irregularities'] = lambda: selection.parameterized(db_path, "animals measurements irregularities", cache=cache)
+	if treatments:
+		#the concurrent and sequential selections return the same result, and therefore share the cached result
+		if cache:
+			selections['treatments'] = lambda: cached_result(db_path, ['animal treatments'], lambda: selection.animal_treatments(db_path, concurrent=concurrent))
+		else:
+			selections['treatments'] = lambda: selection.animal_treatments(db_path, concurrent=concurrent)
+	selections = run_selections(selections, concurrent=concurrent)
+
+	df = selections['info']
 
 	collapse = {
-		'Animal_death_date' : lambda x: ', '.join(set([str(i) for i in x])),
-		'Genotype_code' : lambda x: ', '.join(set([str(i) for i in x])),
+		'Animal_death_date' : unique_join(),
+		'Genotype_code' : unique_join(),
 		}
 	short_identifiers = make_identifier_short_form(df)
 	df = short_identifiers.join(collapse_rename(df, 'AnimalExternalIdentifier_animal_id', collapse))
 	df.reset_index().set_index('Animal_id', inplace=True)
 
 	if functional_scan_responders:
-		count_scans = {'occurences' : lambda x: sum(x),}
+		count_scans = {'occurences' : 'sum',}
 
 		collapse = {
-			'StimulationProtocol_code' : lambda x: 0 if list(x) == [] else 1,
-			"Animal_id" : lambda x: list(x)[0],
+			'StimulationProtocol_code' : any_contains(),
+			"Animal_id" : 'first',
 			}
 		rename = {'StimulationProtocol_code': 'occurences'}
-		functional_scan_df = selection.parameterized(db_path, "animals measurements")
+		functional_scan_df = selections['measurements']
 		functional_scan_df = collapse_rename(functional_scan_df, "Measurement_id", collapse, rename)
 		functional_scan_df = collapse_rename(functional_scan_df, 'Animal_id', count_scans)
 
 		collapse = {
-			'Irregularity_description' : lambda x: 1 if "ICA failed to indicate response to stimulus" in list(x) else 0,
-			"Animal_id" : lambda x: list(x)[0],
+			'Irregularity_description' : any_contains("ICA failed to indicate response to stimulus"),
+			"Animal_id" : 'first',
 			}
 		rename ={'Irregularity_description': 'occurences'}
-		nonresponder_df = selection.parameterized(db_path, "animals measurements irregularities")
+		nonresponder_df = selections['irregularities']
 		nonresponder_df = collapse_rename(nonresponder_df, 'Measurement_id', collapse, rename)
 		nonresponder_df = collapse_rename(nonresponder_df, 'Animal_id', count_scans)
 
@@ -103,17 +123,16 @@ def animals_info(db_path,
 		df.drop(['nonresponsive', 'functional'], axis = 1, inplace = True, errors = 'ignore')
 
 	if treatments:
-		treatments_df = selection.animal_treatments(db_path)
+		treatments_df = selections['treatments']
 		collapse_treatments = {
-			'TreatmentProtocol_code' : lambda x: ', '.join(set([str(i) for i in x if i])),
-			'Cage_TreatmentProtocol_code' : lambda x: ', '.join(set([i for i in x if i])),
+			'TreatmentProtocol_code' : unique_join(skip_empty=True),
+			'Cage_TreatmentProtocol_code' : unique_join(skip_empty=True),
 			}
 		treatments_rename = {
 			'TreatmentProtocol_code': 'animal_treatment',
 			'Cage_TreatmentProtocol_code': 'cage_treatment',
 			}
-		treatments_df = treatments_df.groupby('Animal_id').agg(collapse_treatments)
-		treatments_df = treatments_df.rename(columns=treatments_rename)
+		treatments_df = collapse_rename(treatments_df, 'Animal_id', collapse_treatments, treatments_rename)
 		df['animal_treatment'] = treatments_df["animal_treatment"]
 		df['cage_treatment'] = treatments_df["cage_treatment"]
 
@@ -199,25 +218,8 @@ def cage_consumption(db_path, df,
 
 	selected_cages = list(df['Cage_id'].unique())
 	occupancy_df = selection.cage_periods(db_path, cage_filter=selected_cages)
-	df['occupancy']=''
-	for measurement in df['DrinkingMeasurement_id'].tolist():
-		selected = df[df['DrinkingMeasurement_id']==measurement]
-		measurement_start = selected['DrinkingMeasurement_reference_date'].values[0]
-		measurement_end = selected['DrinkingMeasurement_date'].values[0]
-		cage_id = selected['Cage_id'].values[0]
-		occupants = occupancy_df[
-				(occupancy_df['CageStay_start_date']<=measurement_start)&
-				(
-					(occupancy_df['CageStay_end_date']>=measurement_end)|
-					(occupancy_df['CageStay_end_date'].isnull())
-				)&
-				(occupancy_df['Cage_id']==cage_id)
-				]
-		if True in occupants['Animal_id'].duplicated().tolist():
-			print(occupants)
-			raise ValueError('An animal ist listed twice in the occupancy list of a cage (printed above). This biases the occupancy evaluation, and is likely diagnostic of a broader processing error.')
-		occupancy = len(occupants.index)
-		df.loc[(df['DrinkingMeasurement_id']==measurement),'occupancy'] = occupancy
+	occupancy = CageOccupancy(occupancy_df)
+	df['occupancy'] = occupancy.occupancy(df['Cage_id'], df['DrinkingMeasurement_reference_date'], df['DrinkingMeasurement_date'])
 	df['consumption'] = df['DrinkingMeasurement_start_amount']-df['DrinkingMeasurement_end_amount']
 	if treatment_relative_date:
 		df['relative_start_date'] = ''
@@ -263,7 +265,7 @@ def append_external_identifiers(db_path, df,
 	collapse = {}
 	if concatenate:
 		for i in concatenate:
-			collapse[i] = lambda x: ', '.join(set([str(i) for i in x]))
+			collapse[i] = unique_join()
 	short_identifiers = make_identifier_short_form(df_id)
 	df_id = short_identifiers.join(collapse_rename(df_id, 'AnimalExternalIdentifier_animal_id', collapse))
 	df_id.reset_index(inplace=True)
@@ -346,6 +348,7 @@ def qualitative_dates(df,
 def animal_weights(db_path,
 	reference={},
 	rounding="D",
+	onset="first",
 	):
 	"""
 	Return a dataframe containing animal weights and dates.
@@ -357,8 +360,11 @@ def animal_weights(db_path,
 		Path to database file to query.
 	reference : dict, optional
 		Dictionary based on which to apply a reference date for the dates of each animal. Keys of this dictionary must be "animal" or "cage", and values must be lists of treatment codes.
+		Weights of animals which did not receive any of the treatments are dropped.
 	rounding : string, optional
 		Whether to round dates and timedeltas - use strings as supported by pandas. [1]_
+	onset : {"first", "earliest", "latest"}, optional
+		Which treatment onset to use as the reference date of animals which received more than one of the `reference` treatments (or one treatment more than once): the onset of the first treatment row as selected from the database, or the earliest or latest onset.
 
 	References
 	----------
@@ -370,9 +376,9 @@ def animal_weights(db_path,
 	df = selection.parameterized(db_path, "animals weights")
 	short_identifiers = make_identifier_short_form(df, index_name="WeightMeasurement_id")
 	collapse = {
-		'WeightMeasurement_date' : lambda x: list(set(x))[0] if (len(set(x)) == 1) else "WARNING: different values were present for this entry. Data in this entire DataFrame may not be trustworthy.",
-		'WeightMeasurement_weight' : lambda x: list(set(x))[0] if (len(set(x)) == 1) else "WARNING: different values were present for this entry. Data in this entire DataFrame may not be trustworthy.",
-		'AnimalExternalIdentifier_animal_id' : lambda x: list(set(x))[0] if (len(set(x)) == 1) else "WARNING: different values were present for this entry. Data in this entire DataFrame may not be trustworthy.",
+		'WeightMeasurement_date' : first_unique(),
+		'WeightMeasurement_weight' : first_unique(),
+		'AnimalExternalIdentifier_animal_id' : first_unique(),
 		}
 	rename = {
 		'WeightMeasurement_date': 'date',
@@ -386,13 +392,16 @@ def animal_weights(db_path,
 		elif list(reference.keys())[0] == 'cage':
 			start_date_label = 'Cage_Treatment_start_date'
 		onsets = treatment_group(db_path, list(reference.values())[0], level=list(reference.keys())[0])
-		df['relative_date'] = ''
-		df['relative_date'] = df['relative_date'].astype('timedelta64[ns]')
-		for subject in df["Animal_id"]:
-			try:
-				df.loc[df["Animal_id"]==subject,"relative_date"] = df.loc[df["Animal_id"]==subject,"date"]-onsets.loc[onsets["Animal_id"]==subject, start_date_label].values[0]
-			except IndexError:
-				df.drop(df[df["Animal_id"]==subject].index, inplace=True)
+		if onset == "first":
+			onset_dates = onsets.drop_duplicates('Animal_id').set_index('Animal_id')[start_date_label]
+		elif onset == "earliest":
+			onset_dates = onsets.groupby('Animal_id')[start_date_label].min()
+		elif onset == "latest":
+			onset_dates = onsets.groupby('Animal_id')[start_date_label].max()
+		else:
+			raise ValueError('The `onset` parameter needs to be one of "first", "earliest", or "latest", but is "{}".'.format(onset))
+		df = df[df['Animal_id'].isin(onset_dates.index)].copy()
+		df['relative_date'] = df['date'] - pd.to_datetime(df['Animal_id'].map(onset_dates))
 		df = pd.merge(df, onsets, on='Animal_id', how='outer')
 		if rounding:
 			df['relative_date'] = df['relative_date'].dt.round(rounding)
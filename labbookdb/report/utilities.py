@@ -1,5 +1,18 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 
+#cached results are stored in a directory named after the database file, with this suffix
+RESULT_CACHE_SUFFIX = ".cache"
+#value assigned by `first_unique()` to groups with more than one distinct value
+CONFLICT_WARNING = "WARNING: different values were present for this entry. Data in this entire DataFrame may not be trustworthy."
+
 def concurrent_cagetreatment(df, cagestays,
 	protect_duplicates=[
 		'Animal_id',
@@ -37,31 +50,179 @@ def concurrent_cagetreatment(df, cagestays,
 	This function checks whether cage-level treatment onsets indeed happened during the period in which the animal was housed in the cage.
 	We do not check for the treatment end dates, as an animal which has received a partial treatment has received a treatment.
 	Checks for treatment discontinuation due to e.g. death should be performed elsewhere.
+	The check is performed once per cage stay, based on the first row of the stay, and all rows of non-concurrent cage stays are dropped.
 	"""
-	drop_idx = []
-	for subject in list(df['Animal_id'].unique()):
-		stay_starts = df[df['Animal_id']==subject]['CageStay_start_date'].tolist()
-		# The per-animal treatment info is recorded in each table row, but if the animal only has one cage stay without a cage treatment, it will be deleted, taking the animal treatment information with it.
-		# We avoid this here:
-		blank_cells_only = False
-		if len(stay_starts) == 1:
-			if df.loc[df['Animal_id']==subject, 'TreatmentProtocol_code'].item() != None:
-				blank_cells_only = True
-		for stay_start in stay_starts:
-			stay_end = cagestays[(cagestays['Animal_id']==subject)&(cagestays['CageStay_start_date']==stay_start)]['CageStay_end_date'].tolist()[0]
-			treatment_start = df[(df['Animal_id']==subject)&(df['CageStay_start_date']==stay_start)]['Cage_Treatment_start_date'].tolist()[0]
-			death_date = df[df['Animal_id']==subject]['Animal_death_date'].tolist()[0]
-			# We do not check for treatment end dates, because often you may want to include recipients of incomplete treatments (e.g. due to death) when filtering based on cagestays.
-			# Filtering based on death should be done elsewhere.
-			if treatment_start <= stay_start or treatment_start >= stay_end or treatment_start >= death_date:
-				if blank_cells_only:
-					df.loc[df['Animal_id']==subject, ['Cage_TreatmentProtocol_code', 'Cage_Treatment_start_date', 'Cage_Treatment_end_date', 'Cage_Treatment_protocol_id']] = None
-				else:
-					drop_idx.extend(df[(df['Animal_id']==subject)&(df['CageStay_start_date']==stay_start)].index.tolist())
-	df = df.drop(drop_idx)
+	# Each cage stay is matched with its end date and with the treatment onset of its first row, and all concurrency conditions are evaluated at once.
+	stay_keys = ['Animal_id','CageStay_start_date']
+	stay_ends = cagestays[stay_keys+['CageStay_end_date']].drop_duplicates(subset=stay_keys)
+	first_treatments = df[stay_keys+['Cage_Treatment_start_date']].drop_duplicates(subset=stay_keys)
+	stays = df[stay_keys].merge(first_treatments, on=stay_keys, how='left').merge(stay_ends, on=stay_keys, how='left')
+	stay_end = pd.to_datetime(stays['CageStay_end_date']).values
+	treatment_start = pd.to_datetime(stays['Cage_Treatment_start_date']).values
+	stay_start = pd.to_datetime(df['CageStay_start_date']).values
+	death_dates = df[['Animal_id','Animal_death_date']].drop_duplicates(subset='Animal_id').set_index('Animal_id')['Animal_death_date']
+	death_date = pd.to_datetime(df['Animal_id'].map(death_dates)).values
+	# We do not check for treatment end dates, because often you may want to include recipients of incomplete treatments (e.g. due to death) when filtering based on cagestays.
+	# Filtering based on death should be done elsewhere.
+	nonconcurrent = pd.Series((treatment_start <= stay_start) | (treatment_start >= stay_end) | (treatment_start >= death_date), index=df.index)
+
+	# The per-animal treatment info is recorded in each table row, but if the animal only has one cage stay without a cage treatment, it will be deleted, taking the animal treatment information with it.
+	# We avoid this here:
+	single_row = df.groupby('Animal_id')['Animal_id'].transform('size') == 1
+	animal_treatment = pd.Series(df['TreatmentProtocol_code'].values != None, index=df.index)
+	blank_cells_only = single_row & animal_treatment
+
+	df = df.copy()
+	df.loc[nonconcurrent & blank_cells_only, ['Cage_TreatmentProtocol_code', 'Cage_Treatment_start_date', 'Cage_Treatment_end_date', 'Cage_Treatment_protocol_id']] = None
+	df = df.drop(df.index[nonconcurrent & ~blank_cells_only])
 	#df = df.drop_duplicates(subset=protect_duplicates)
 	return df
 
+def cagestay_end_dates(df):
+	"""
+	Return a `pandas.Series` object containing the end date of each cage stay, i.e. the start date of the next cage stay of the same animal, or the animal death date if there is no next cage stay.
+
+	Parameters
+	----------
+
+	df : pandas.DataFrame
+		Pandas Dataframe, with columns containing:
+			`Animal_id`,
+			`Animal_death_date`,
+			`CageStay_start_date`.
+
+	Returns
+	-------
+
+	pandas.Series
+		Cage stay end dates, with the same index as `df`.
+
+	Notes
+	-----
+
+	Rows are sorted by start date within each animal, and the next distinct start date is assigned by shifting, so that the cost is linear in the number of cage stays.
+	Cage stays without a start date are assigned no end date.
+	"""
+	stays = df[['Animal_id','CageStay_start_date']].dropna().drop_duplicates()
+	stays = stays.sort_values(['Animal_id','CageStay_start_date'])
+	stays['CageStay_end_date'] = stays.groupby('Animal_id')['CageStay_start_date'].shift(-1)
+	death_dates = pd.to_datetime(df.groupby('Animal_id')['Animal_death_date'].first())
+	stays['CageStay_end_date'] = stays['CageStay_end_date'].fillna(stays['Animal_id'].map(death_dates))
+	end_dates = df[['Animal_id','CageStay_start_date']].merge(stays, on=['Animal_id','CageStay_start_date'], how='left')['CageStay_end_date']
+	end_dates.index = df.index
+	return pd.to_datetime(end_dates)
+
+class CageOccupancy(object):
+	"""
+	Index of cage stays, which answers which animals were housed in a cage throughout a given period.
+
+	Parameters
+	----------
+
+	cagestays : pandas.DataFrame
+		Pandas Dataframe, with columns containing:
+			`Animal_id`,
+			`Cage_id`,
+			`CageStay_end_date`,
+			`CageStay_start_date`.
+		This can be obtained e.g. from `labbookdb.report.selection.cage_periods()`.
+
+	Notes
+	-----
+
+	The index is built once, and stores the cage stays sorted by cage and start date.
+	Lookups use a binary search to find the stays which started before the period, and a vectorized comparison of their end dates.
+	An animal is considered to be housed in the cage throughout the period if its stay started on or before the period start, and ended on or after the period end (or has no end date).
+	"""
+	def __init__(self, cagestays):
+		self.cagestays = cagestays
+		stays = cagestays.dropna(subset=['CageStay_start_date'])
+		stays = stays.sort_values(['Cage_id','CageStay_start_date'], kind='mergesort')
+		self.start_dates = pd.to_datetime(stays['CageStay_start_date']).values
+		self.end_dates = pd.to_datetime(stays['CageStay_end_date']).values
+		self.animal_codes = pd.factorize(stays['Animal_id'])[0]
+		self.labels = stays.index.values
+		cage_ids, bounds = np.unique(stays['Cage_id'].values, return_index=True)
+		bounds = np.append(bounds, len(stays.index))
+		self.cages = {cage_id:(bounds[ix], bounds[ix+1]) for ix, cage_id in enumerate(cage_ids)}
+
+	def _covering(self, cage_id, start_dates, end_dates):
+		"""Return a boolean matrix indicating which stays (columns) of a cage cover which periods (rows), and the slice of the cage in the index."""
+		try:
+			cage = slice(*self.cages[cage_id])
+		except KeyError:
+			return np.zeros((len(start_dates), 0), dtype=bool), None
+		stay_starts = self.start_dates[cage]
+		stay_ends = self.end_dates[cage]
+		started = np.searchsorted(stay_starts, start_dates, side='right')
+		started[np.isnat(start_dates)] = 0
+		covering = np.arange(len(stay_starts))[np.newaxis,:] < started[:,np.newaxis]
+		covering &= (stay_ends[np.newaxis,:] >= end_dates[:,np.newaxis]) | np.isnat(stay_ends)[np.newaxis,:]
+		return covering, cage
+
+	def occupants(self, cage_id, start_date, end_date):
+		"""
+		Return a `pandas.DataFrame` object containing the cage stays (rows of `cagestays`) covering a period in a cage.
+
+		Parameters
+		----------
+
+		cage_id : int
+			`Cage.id` value of the cage.
+		start_date : datetime-like
+			Start of the period.
+		end_date : datetime-like
+			End of the period.
+		"""
+		start_dates = pd.to_datetime(pd.Series([start_date])).values
+		end_dates = pd.to_datetime(pd.Series([end_date])).values
+		covering, cage = self._covering(cage_id, start_dates, end_dates)
+		if cage is None:
+			return self.cagestays.iloc[:0]
+		return self.cagestays.loc[self.labels[cage][covering[0]]]
+
+	def occupancy(self, cage_ids, start_dates, end_dates):
+		"""
+		Return a `numpy.ndarray` object containing the number of animals housed in each cage throughout each period.
+
+		Parameters
+		----------
+
+		cage_ids : array-like
+			`Cage.id` values of the cages.
+		start_dates : array-like
+			Start of each period.
+		end_dates : array-like
+			End of each period.
+
+		Notes
+		-----
+
+		All periods of a cage are evaluated in one batch.
+		If an animal has more than one stay covering a period, a `ValueError` is raised, as this biases the occupancy evaluation and is likely diagnostic of a broader processing error.
+		"""
+		cage_ids = np.asarray(cage_ids)
+		start_dates = pd.to_datetime(pd.Series(start_dates)).values
+		end_dates = pd.to_datetime(pd.Series(end_dates)).values
+		occupancy = np.zeros(len(cage_ids), dtype=int)
+		order = np.argsort(cage_ids, kind='mergesort')
+		query_cages, bounds = np.unique(cage_ids[order], return_index=True)
+		for cage_id, selected in zip(query_cages, np.split(order, bounds[1:])):
+			covering, cage = self._covering(cage_id, start_dates[selected], end_dates[selected])
+			if cage is None:
+				continue
+			animal_codes = self.animal_codes[cage]
+			animals, animal_codes = np.unique(animal_codes, return_inverse=True)
+			if len(animals) < len(animal_codes):
+				animal_stays = np.zeros((len(animal_codes), len(animals)), dtype=int)
+				animal_stays[np.arange(len(animal_codes)), animal_codes] = 1
+				duplicates = (covering.astype(int).dot(animal_stays) > 1).any(axis=1)
+				if duplicates.any():
+					print(self.cagestays.loc[self.labels[cage][covering[np.flatnonzero(duplicates)[0]]]])
+					raise ValueError('An animal ist listed twice in the occupancy list of a cage (printed above). This biases the occupancy evaluation, and is likely diagnostic of a broader processing error.')
+			occupancy[selected] = covering.sum(axis=1)
+		return occupancy
+
 def make_identifier_short_form(df,
 	index_name="Animal_id"):
 	"""
@@ -79,11 +240,112 @@ def make_identifier_short_form(df,
 	df = df.unstack(1)
 	return df
 
+def _collapse_operation(collapse, vectorized):
+	"""Attach a vectorized implementation to a per-group collapse function, which `collapse_rename()` uses instead of calling the function once per group."""
+	collapse.vectorized = vectorized
+	return collapse
+
+def _strings(values):
+	"""Convert the values of a `pandas.Series` object to strings, as `str()` would convert the individual values."""
+	if pd.api.types.is_datetime64_any_dtype(values) or pd.api.types.is_timedelta64_dtype(values):
+		#`astype(str)` formats midnight timestamps as dates only
+		return values.map(str)
+	return values.astype(str)
+
+def unique_join(separator=', ',
+	skip_empty=False,
+	):
+	"""
+	Return a collapse operation which joins the distinct string representations of the values of each group, in the order of their first occurrence.
+
+	Parameters
+	----------
+
+	separator : string, optional
+		String with which to join the values.
+	skip_empty : bool, optional
+		Whether to skip values which evaluate to `False` (e.g. `None` or empty strings).
+		Groups with no other values are collapsed to an empty string.
+	"""
+	def collapse(x):
+		return separator.join(dict.fromkeys(str(i) for i in x if i or not skip_empty))
+	def vectorized(values, groupby, index):
+		pairs = pd.DataFrame({'group': groupby, 'value': _strings(values)})
+		if skip_empty:
+			pairs = pairs[values.astype(bool) if values.dtype == object else values.map(bool)]
+		pairs = pairs[pairs['group'].notnull()].drop_duplicates().sort_values('group', kind='mergesort')
+		if pairs.empty:
+			return pd.Series('', index=index)
+		#string concatenation over contiguous groups, rather than one `str.join()` call per group
+		groups = pairs['group'].to_numpy()
+		starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+		strings = pairs['value'].to_numpy(dtype=object) + separator
+		ends = np.r_[starts[1:], len(strings)] - 1
+		strings[ends] = pairs['value'].to_numpy(dtype=object)[ends]
+		joined = pd.Series(np.add.reduceat(strings, starts), index=groups[starts])
+		return joined.reindex(index, fill_value='')
+	return _collapse_operation(collapse, vectorized)
+
+def first_unique(conflict=CONFLICT_WARNING):
+	"""
+	Return a collapse operation which takes the value of each group, if it is the only distinct value of the group, or the `conflict` value otherwise.
+
+	Parameters
+	----------
+
+	conflict : optional
+		Value to assign to groups with more than one distinct value.
+	"""
+	def collapse(x):
+		unique = x.unique()
+		return unique[0] if len(unique) == 1 else conflict
+	def vectorized(values, groupby, index):
+		grouped = values.groupby(groupby)
+		unique = grouped.nunique(dropna=False) == 1
+		if unique.all():
+			return grouped.first()
+		return grouped.first().where(unique, conflict)
+	return _collapse_operation(collapse, vectorized)
+
+def count_where(value=None):
+	"""
+	Return a collapse operation which counts the values of each group which are equal to `value`, or all values of each group if `value` is None.
+
+	Parameters
+	----------
+
+	value : optional
+		Value to count.
+	"""
+	def collapse(x):
+		return len(x) if value is None else int((x == value).sum())
+	def vectorized(values, groupby, index):
+		if value is None:
+			return values.groupby(groupby).size()
+		return (values == value).groupby(groupby).sum().astype(int)
+	return _collapse_operation(collapse, vectorized)
+
+def any_contains(value=None):
+	"""
+	Return a collapse operation which assigns 1 to groups which contain `value` (or any value, if `value` is None), and 0 to other groups.
+
+	Parameters
+	----------
+
+	value : optional
+		Value to look for.
+	"""
+	def collapse(x):
+		return int(count_where(value)(x) > 0)
+	def vectorized(values, groupby, index):
+		return (count_where(value).vectorized(values, groupby, index) > 0).astype(int)
+	return _collapse_operation(collapse, vectorized)
+
 def collapse_rename(df, groupby, collapse,
 	rename=False,
 	):
 	"""
-	Collapse long form columns according to a lambda function, so that groupby column values are rendered unique
+	Collapse long form columns according to a lambda function or named collapse operation, so that groupby column values are rendered unique
 
 	Parameters
 	----------
@@ -93,16 +355,66 @@ def collapse_rename(df, groupby, collapse,
 	groupby : string
 		The name of a column from `df`, the values of which you want to render unique.
 	collapse : dict
-		A dictionary the keys of which are columns you want to collapse, and the values of which are lambda functions instructing how to collapse (e.g. concatenate) the values.
+		A dictionary the keys of which are columns you want to collapse, and the values of which are lambda functions, names of pandas aggregations (e.g. "sum"), or collapse operations (`unique_join()`, `first_unique()`, `count_where()`, `any_contains()`) instructing how to collapse (e.g. concatenate) the values.
 	rename : dict, optional
 		A dictionary the keys of which are names of columns from `df`, and the values of which are new names for these columns.
+
+	Notes
+	-----
+
+	Lambda functions are called once per group, whereas collapse operations are computed for all groups at once.
 	"""
-	df = df.groupby(groupby).agg(collapse)
+	vectorized = {key: value for key, value in collapse.items() if hasattr(value, 'vectorized')}
+	grouped = df.groupby(groupby)
+	if len(vectorized) == len(collapse):
+		collapsed = pd.DataFrame(index=grouped.size().index)
+	else:
+		collapsed = grouped.agg({key: value for key, value in collapse.items() if key not in vectorized})
+	for key, value in vectorized.items():
+		collapsed[key] = value.vectorized(df[key], df[groupby], collapsed.index)
+	df = collapsed[list(collapse)]
 	if rename:
 		df = df.rename(columns=rename)
 
 	return df
 
+def iter_collapse_rename(dfs, groupby, collapse,
+	rename=False,
+	):
+	"""
+	Collapse long form columns of consecutive `pandas.DataFrame` chunks (e.g. as yielded by `labbookdb.db.query.iter_df()`), yielding one collapsed `pandas.DataFrame` per chunk.
+
+	Parameters
+	----------
+
+	dfs : iterable of pandas.DataFrame
+		`pandas.DataFrame` objects, the rows of which are sorted by the `groupby` column across all chunks.
+	groupby : string
+		The name of a column from the chunks, the values of which you want to render unique.
+	collapse : dict
+		A dictionary the keys of which are columns you want to collapse, and the values of which are lambda functions instructing how to collapse (e.g. concatenate) the values.
+	rename : dict, optional
+		A dictionary the keys of which are names of columns from the chunks, and the values of which are new names for these columns.
+
+	Notes
+	-----
+
+	As a group may be split across two chunks, the rows of the last group of each chunk are carried over to the next chunk, so that the concatenated output is equal to the output of `collapse_rename()` on the concatenated chunks.
+	"""
+	carry = None
+	for df in dfs:
+		if carry is not None:
+			df = pd.concat([carry, df])
+		if df.empty:
+			carry = df
+			continue
+		complete = (df[groupby] != df[groupby].iloc[-1]).values
+		carry = df[~complete]
+		if complete.any():
+			yield collapse_rename(df[complete], groupby, collapse, rename)
+	if carry is not None and not carry.empty:
+		yield collapse_rename(carry, groupby, collapse, rename)
+
 def relativize_dates(df,
 	date_suffix='_date',
 	rounding='D',
@@ -123,6 +435,11 @@ def relativize_dates(df,
 		Datetime increment for date rounding.	
 	rounding_type : {'round','floor','ceil'}, optional
 		Whether to round the dates (splits e.g. days apart at noon, hours at 30 minutes, etc.) or to take the floor or the ceiling.
+
+	Notes
+	-----
+
+	Dates are computed row by row, so that chunks (e.g. as yielded by `labbookdb.db.query.iter_df()`) can be processed independently.
 	"""
 
 	if isinstance(reference_date, bool) and reference_date:
@@ -146,3 +463,126 @@ def relativize_dates(df,
 				elif rounding_type == 'ceil':
 					df[date_column] = df[date_column].dt.ceil(rounding)
 	return df
+
+def db_state(db_path,
+	table_names=None,
+	):
+	"""
+	Return a string which changes whenever the database (or the given tables thereof) is modified.
+
+	Parameters
+	----------
+
+	db_path : string
+		Path to the database file.
+	table_names : list of str, optional
+		Names of the tables to track.
+		If None, all tables are tracked.
+
+	Notes
+	-----
+
+	The state is based on the identity of the database file (its inode, and the random database identifier, see `labbookdb.db.query.database_id()`) and the database revision counter (see `labbookdb.db.query.revision()`).
+	It falls back to the modification time and size of the database file for databases without revision records.
+	"""
+	from labbookdb.db.query import database_id, revision
+
+	db_stat = os.stat(os.path.abspath(os.path.expanduser(db_path)))
+	db_revision = revision(db_path, table_names or [])
+	if db_revision is None:
+		return "{}-{}-{}".format(db_stat.st_ino, db_stat.st_mtime_ns, db_stat.st_size)
+	return "{}-{}-r{}".format(db_stat.st_ino, database_id(db_path), db_revision)
+
+def cached_result(db_path, key, compute,
+	table_names=None,
+	):
+	"""
+	Return a `pandas.DataFrame` object from an on-disk columnar cache next to the database file, computing and caching it if the cache is missing or outdated.
+
+	Parameters
+	----------
+
+	db_path : string
+		Path to the database file from which the result is computed.
+	key : list
+		JSON-serializable list (non-serializable items are converted to strings) uniquely identifying the result, e.g. the data type and filters of a selection.
+	compute : callable
+		Function, called without arguments, which computes the result.
+	table_names : list of str, optional
+		Names of the tables from which the result is computed.
+		If None, the result is invalidated by changes to any table.
+
+	Notes
+	-----
+
+	Results are stored in the Feather format, which requires `pyarrow` (installed with the "cache" extra of LabbookDB); if it is not available, results are computed, and not cached.
+	Results which cannot be stored in the Feather format (e.g. with a non-default index), or for which the cache directory is not writable, are returned without being cached.
+	Cached results are keyed on the state of the tables they are computed from (see `db_state()`), so that any change to these tables invalidates them; outdated cache files are removed when a result is cached anew.
+	"""
+	try:
+		import pyarrow
+	except ImportError:
+		return compute()
+	try:
+		state = db_state(db_path, table_names)
+	except OSError:
+		return compute()
+	key_hash = hashlib.sha1(json.dumps(key, default=str).encode('utf-8')).hexdigest()
+	cache_dir = os.path.abspath(os.path.expanduser(db_path)) + RESULT_CACHE_SUFFIX
+	base = os.path.join(cache_dir, key_hash)
+	cache_path = '{}-{}.feather'.format(base, state)
+	if os.path.exists(cache_path):
+		try:
+			return pd.read_feather(cache_path)
+		except (OSError, pyarrow.ArrowException):
+			pass
+
+	df = compute()
+	temporary = '{}-{}.{}.{}.tmp'.format(base, state, os.getpid(), threading.get_ident())
+	try:
+		os.makedirs(cache_dir, exist_ok=True)
+		for outdated in glob.glob(base+'-*'):
+			try:
+				os.remove(outdated)
+			except OSError:
+				pass
+		df.to_feather(temporary)
+		os.replace(temporary, cache_path)
+	except (OSError, ValueError, pyarrow.ArrowException):
+		try:
+			os.remove(temporary)
+		except OSError:
+			pass
+	return df
+
+def run_selections(selections,
+	concurrent=False,
+	):
+	"""
+	Return the results of independent selections, computed one after another, or concurrently on a thread pool.
+
+	Parameters
+	----------
+
+	selections : dict
+		Dictionary the values of which are functions which are called without arguments, e.g. to select a `pandas.DataFrame` object from a database.
+	concurrent : bool, optional
+		Whether to call the functions concurrently, each on its own thread.
+
+	Returns
+	-------
+
+	dict
+		Dictionary with the keys of `selections`, and the values returned by the corresponding functions.
+
+	Notes
+	-----
+
+	Concurrent selections from the same database each check out their own connection from the pool of the read-only engine (see `labbookdb.db.connection.get_engine()`), and SQLite executes queries without holding the Python global interpreter lock, so that the queries of different selections overlap.
+	If a selection raises an exception, it is re-raised once all selections have finished.
+	"""
+	if not concurrent or len(selections) < 2:
+		return {key: select() for key, select in selections.items()}
+	with ThreadPoolExecutor(max_workers=len(selections)) as executor:
+		futures = {key: executor.submit(select) for key, select in selections.items()}
+	return {key: future.result() for key, future in futures.items()}
@@ -4,3 +4,105 @@ def test_load():
 	session, engine = add.load_session("/tmp/somepath.db")
 	session.close()
 	engine.dispose()
+
+def test_engine_reuse():
+	from labbookdb.db import query
+
+	session, engine = query.load_session("/tmp/somepath.db")
+	session.close()
+	session, engine_ = query.load_session("/tmp/../tmp/somepath.db")
+	session.close()
+	assert engine is engine_
+
+	query.dispose_engines("/tmp/somepath.db")
+	session, engine_ = query.load_session("/tmp/somepath.db")
+	session.close()
+	assert engine is not engine_
+
+def test_sqlite_profiles(tmpdir):
+	from labbookdb.db import query
+
+	db_path = str(tmpdir.join("meta.db"))
+	engine = query.get_engine(db_path)
+	with engine.connect() as connection:
+		assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+		assert connection.execute("PRAGMA synchronous").scalar() == 1
+		assert connection.execute("PRAGMA foreign_keys").scalar() == 1
+	reader_engine = query.get_engine(db_path, "read-only")
+	assert reader_engine is not engine
+	with reader_engine.connect() as connection:
+		assert connection.execute("PRAGMA temp_store").scalar() == 2
+
+	#readers are not blocked by a pending write transaction
+	session, engine = add.load_session(db_path)
+	session.add(add.Cage(id=1))
+	session.flush()
+	df = query.get_df(db_path, col_entries=[("Cage","id")])
+	assert df.empty
+	session.commit()
+	session.close()
+	assert query.get_df(db_path, col_entries=[("Cage","id")])["Cage_id"].tolist() == [1]
+	query.dispose_engines(db_path)
+	assert not [i for i in query.ENGINES if i[0] == db_path]
+
+def test_session_scope(tmpdir):
+	import pytest
+	from labbookdb.db import connection, query
+
+	db_path = str(tmpdir.join("meta.db"))
+	#writes and reads of a process share the engines of the connection manager
+	assert add.load_session(db_path)[1] is query.load_session(db_path)[1] is connection.get_engine(db_path)
+
+	with connection.session_scope(db_path) as session:
+		session.add(add.Cage(id=1))
+	with pytest.raises(ValueError):
+		with connection.session_scope(db_path) as session:
+			session.add(add.Cage(id=2))
+			session.flush()
+			raise ValueError
+	with connection.session_scope(db_path, "read-only") as session:
+		assert [i.id for i in session.query(add.Cage)] == [1]
+		assert session.bind is connection.get_engine(db_path, "read-only")
+	with pytest.raises(ValueError):
+		connection.load_session(db_path, "write-only")
+	query.dispose_engines(db_path)
+
+def test_read_only(tmpdir):
+	import pytest
+	import sqlalchemy
+	from labbookdb.db import connection, query
+
+	db_path = str(tmpdir.join("meta.db"))
+	with pytest.raises(FileNotFoundError):
+		query.get_df(db_path, col_entries=[("Cage","id")])
+	query.init_db(db_path)
+	assert query.get_df(db_path, col_entries=[("Cage","id")]).empty
+
+	#read-only connections neither create the schema, nor write
+	legacy_path = str(tmpdir.join("legacy.db"))
+	sqlalchemy.create_engine("sqlite:///"+legacy_path).execute("CREATE TABLE cages (id INTEGER PRIMARY KEY)")
+	engine = connection.get_engine(legacy_path, "read-only")
+	assert sqlalchemy.inspect(engine).get_table_names() == ["cages"]
+	with pytest.raises(sqlalchemy.exc.OperationalError):
+		with connection.session_scope(legacy_path, "read-only") as session:
+			session.execute("INSERT INTO cages (id) VALUES (1)")
+	query.dispose_engines(db_path)
+	query.dispose_engines(legacy_path)
+
+def test_replaced_database(tmpdir):
+	import os
+	from labbookdb.db import connection, query
+
+	db_path = str(tmpdir.join("meta.db"))
+	new_path = str(tmpdir.join("new.db"))
+	add.add_generic(db_path, {"CATEGORY":"Cage","id":1})
+	assert query.get_df(db_path, col_entries=[("Cage","id")])["Cage_id"].tolist() == [1]
+	add.add_generic(new_path, {"CATEGORY":"Cage","id":2})
+	query.dispose_engines(new_path)
+
+	#pooled connections of the process are not reused once the database file is replaced
+	with connection.get_engine(db_path).connect() as connection:
+		connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+	os.replace(new_path, db_path)
+	assert query.get_df(db_path, col_entries=[("Cage","id")])["Cage_id"].tolist() == [2]
+	query.dispose_engines(db_path)
@@ -0,0 +1,118 @@
+import os
+import subprocess
+import sys
+
+import labbookdb
+
+def run_cli(code):
+	"""Run Python code in a fresh interpreter, as the LDB executable would be run, and return its standard output."""
+	env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(labbookdb.__file__))))
+	return subprocess.check_output([sys.executable, "-c", code], env=env).decode()
+
+def test_cli_help():
+	from labbookdb.cli import COMMANDS, command_summary, load_command
+
+	for command in COMMANDS:
+		assert callable(load_command(command))
+		assert command_summary(command)
+
+	#the overview is rendered without importing any of the subcommand modules
+	output = run_cli("\n".join([
+		"import sys",
+		"from labbookdb.cli import main",
+		"try:",
+		"	main(['--help'])",
+		"except SystemExit:",
+		"	pass",
+		"print([i for i in ('pandas', 'sqlalchemy', 'argh') if i in sys.modules])",
+		]))
+	assert "cage-info" in output
+	assert "Create a LabbookDB database" in output
+	assert output.split("\n")[-2] == "[]"
+
+def test_cli_lazy_imports(tmpdir):
+	from labbookdb.db import add, query
+
+	db_path = str(tmpdir.join("meta.db"))
+	add.add_generic(db_path, {"CATEGORY":"Cage","id":12})
+	query.dispose_engines(db_path)
+	output = run_cli("import sys; from labbookdb.cli import main; main(['cage-info', {!r}, '12']); print('pandas' in sys.modules)".format(db_path))
+	assert output.startswith("Cage(id: 12")
+	assert output.split()[-1] == "False"
+
+def test_daemon(tmpdir, capsys, monkeypatch):
+	import signal
+	import time
+	import pytest
+	from labbookdb import daemon
+	from labbookdb.db import add, query
+
+	db_path = str(tmpdir.join("meta.db"))
+	socket_path = str(tmpdir.join("ldb.sock"))
+	add.add_generic(db_path, {"CATEGORY":"Cage","id":12})
+	query.dispose_engines(db_path)
+	assert daemon.forward(["cage-info", db_path, "12"], socket_path) is None
+
+	#commands are run locally if the daemon stops without a valid response
+	capsys.readouterr()
+	def broken_daemon(response, delay=0):
+		import socket
+		import threading
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(socket_path)
+		server.listen(1)
+		def respond():
+			connection, _ = server.accept()
+			connection.makefile("rb").readline()
+			time.sleep(delay)
+			connection.sendall(response)
+			connection.close()
+		thread = threading.Thread(target=respond)
+		thread.start()
+		try:
+			return daemon.forward(["cage-info", db_path, "12"], socket_path)
+		finally:
+			thread.join(10)
+			server.close()
+			os.remove(socket_path)
+	assert broken_daemon(b"") is None
+	assert broken_daemon(b'{"stdout": "Cage(id: 12"\n') is None
+	assert broken_daemon(b'{"stdout": ""}\n') is None
+	assert capsys.readouterr().out == ""
+	#the timeout only applies to handing the command over, commands accepted by the daemon may take longer to run
+	monkeypatch.setattr(daemon, "FORWARD_TIMEOUT", 0.1)
+	assert broken_daemon(b'{"stdout": "Cage(id: 12\\n", "stderr": "", "status": 0}\n', delay=0.5) == 0
+	assert capsys.readouterr().out == "Cage(id: 12\n"
+	monkeypatch.undo()
+
+	#only stale sockets are removed
+	with open(socket_path, "w") as f:
+		f.write("notes")
+	with pytest.raises(FileExistsError):
+		daemon.serve(path=socket_path)
+	with open(socket_path) as f:
+		assert f.read() == "notes"
+	os.remove(socket_path)
+
+	env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(labbookdb.__file__))))
+	server = subprocess.Popen([sys.executable, "-m", "labbookdb.cli", "serve", "--path", socket_path], env=env, stdout=subprocess.PIPE)
+	try:
+		assert server.stdout.readline().decode().startswith("Serving LDB commands")
+		capsys.readouterr()
+		#`forward()` only returns an exit status if the command was run by the daemon
+		for i in range(11):
+			assert daemon.forward(["cage-info", db_path, "12"], socket_path) == 0
+		forwarded = capsys.readouterr().out
+		assert forwarded.startswith("Cage(id: 12")
+		assert forwarded.count("Cage(id: 12") == 11
+
+		#relative paths are resolved in the working directory of the client, and errors are reported via the exit status
+		with tmpdir.as_cwd():
+			assert daemon.forward(["cage-info", "meta.db", "12"], socket_path) == 0
+		assert capsys.readouterr().out.startswith("Cage(id: 12")
+		assert daemon.forward(["cage-info"], socket_path) == 2
+		assert "required" in capsys.readouterr().err
+	finally:
+		server.send_signal(signal.SIGINT)
+		server.wait(10)
+	assert not os.path.exists(socket_path)
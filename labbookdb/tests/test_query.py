@@ -10,3 +10,344 @@ def test_related_entry_separators():
 	with pytest.raises(BaseException) as excinfo:
 		add.get_related_ids(session, engine, "Animal:external_ids.AnimalExternalIdentifier:database.ETH/AIC/cdb&&identifier.275511")
 	assert excinfo.value.args[0] == 'No entry was found with a value of "ETH/AIC/cdb" on the "database" column of the "AnimalExternalIdentifier" CATEGORY, in the database.'
+
+def test_statement_cache(tmpdir):
+	from labbookdb.db import query
+
+	db_path = str(tmpdir.join("meta.db"))
+	query.init_db(db_path)
+
+	col_entries = (("Animal","id"),("AnimalExternalIdentifier",))
+	join_entries = (("Animal.external_ids",),)
+	filter_shapes = (("AnimalExternalIdentifier","database","equal"),)
+	statement, _ = query.get_statement(col_entries, join_entries, ("inner",), filter_shapes)
+	assert query.get_statement(col_entries, join_entries, ("inner",), filter_shapes)[0] is statement
+
+	for database in ["ETH/AIC", "ETH/AIC/cdb"]:
+		df = query.get_df(db_path,
+			col_entries=list(col_entries),
+			join_entries=list(join_entries),
+			filters=[["AnimalExternalIdentifier","database",database]],
+			)
+		assert "AnimalExternalIdentifier_identifier" in df.columns
+	query.dispose_engines(db_path)
+
+def test_alias_namespace(tmpdir):
+	from concurrent.futures import ThreadPoolExecutor
+	from labbookdb.db import query
+
+	db_path = str(tmpdir.join("meta.db"))
+	query.init_db(db_path)
+
+	col_entries=[
+		("Animal","id"),
+		("Cage","id"),
+		("Cage","Treatment",""),
+		("Cage","TreatmentProtocol","code"),
+		]
+	join_entries=[
+		("Animal.cage_stays",),
+		("CageStay.cage",),
+		("Cage_Treatment","Cage.treatments"),
+		("Cage_TreatmentProtocol","Cage_Treatment.protocol"),
+		]
+	def cage_treatments(code):
+		return query.get_df(db_path, col_entries=col_entries, join_entries=join_entries, filters=[["Cage_TreatmentProtocol","code",code]])
+	with ThreadPoolExecutor(4) as executor:
+		dfs = list(executor.map(cage_treatments, ["cFluDW", "cFluDW_", "cFluIV", "cFluIV_"]))
+	assert all("Cage_TreatmentProtocol_code" in df.columns for df in dfs)
+	assert "Cage_Treatment" not in query.ALLOWED_CLASSES
+	with pytest.raises(TypeError):
+		query.ALLOWED_CLASSES["Cage_Treatment"] = None
+	query.dispose_engines(db_path)
+
+def test_list_filters(tmpdir):
+	import numpy as np
+	from labbookdb.db import query
+
+	db_path = str(tmpdir.join("meta.db"))
+	query.init_db(db_path)
+
+	col_entries = [("Animal","id"),("Animal","birth_date")]
+	for animals in [np.arange(3), [str(i) for i in range(query.IN_LIST_LIMIT+1)]]:
+		my_filter = ["Animal","id"]
+		my_filter.extend(animals)
+		df = query.get_df(db_path, col_entries=col_entries, filters=[my_filter])
+		assert list(df.columns) == ["Animal_id","Animal_birth_date"]
+	df = query.get_df(db_path, col_entries=col_entries, filters=[["Animal","birth_date","2016,7,21","2016,7,22"]])
+	assert list(df.columns) == ["Animal_id","Animal_birth_date"]
+
+	#filter values are converted to the column type, but not truncated
+	add.add_bulk(db_path, [{"CATEGORY":"Animal","sex":"m"}])
+	for values, animals in [(["1"], [1]), ([np.float64(1)], [1]), ([1.5], []), (["1.5"], []), ([1.5, np.int64(1)], [1])]:
+		df = query.get_df(db_path, col_entries=col_entries, filters=[["Animal","id"]+values])
+		assert df["Animal_id"].tolist() == animals
+	assert query.coerce_value(float("inf"), int) == float("inf")
+	query.dispose_engines(db_path)
+
+def test_related_ids_cache(tmpdir):
+	db_path = str(tmpdir.join("meta.db"))
+	add.add_generic(db_path, {"CATEGORY":"Cage","id":1})
+	add.add_generic(db_path, {"CATEGORY":"Animal","sex":"m","external_ids":[{"CATEGORY":"AnimalExternalIdentifier","database":"ETH/AIC","identifier":"5001"}]})
+
+	selector = "Animal:external_ids.AnimalExternalIdentifier:database.ETH/AIC&#&identifier.5001"
+	assert add.parse_selector(selector) == ("Animal", (("external_ids", ("AnimalExternalIdentifier", (("database", "ETH/AIC"), ("identifier", "5001")))),))
+	assert add.parse_selector(selector) is add.parse_selector(selector)
+
+	session, engine = add.load_session(db_path)
+	cage = session.query(add.Cage).one()
+	ids, sql_query = add.get_related_ids(session, engine, selector)
+	assert ids == [1]
+	assert add.get_related_ids(session, engine, selector)[1] is sql_query
+	assert add.get_related_ids(session, engine, "Cage:id.1")[0] == [1]
+	#the session is left open for the caller
+	assert cage in session
+
+	#entries flushed in the transaction are matched, and only selectors referring to their tables are dropped
+	session.add(add.Cage(id=2))
+	session.flush()
+	assert add.get_related_ids(session, engine, selector)[1] is sql_query
+	assert add.get_related_ids(session, engine, "Cage:id.2")[0] == [2]
+	session.rollback()
+	assert add.get_related_ids(session, engine, selector)[1] is not sql_query
+	with pytest.raises(BaseException):
+		add.get_related_ids(session, engine, "Cage:id.2")
+	session.close()
+
+def test_add_bulk(tmpdir, monkeypatch, capsys):
+	import json
+	from labbookdb.db import query
+
+	db_path = str(tmpdir.join("meta.db"))
+	entries = [{"CATEGORY":"Cage","id":1}]
+	entries.extend([{"CATEGORY":"Animal","sex":"m","cage_stays":[{"CATEGORY":"CageStay","start_date":"2016,4,1","cage_id":"Cage:id.1"}]} for i in range(5)])
+	ndjson = tmpdir.join("entries.ndjson")
+	ndjson.write("\n".join(json.dumps(i) for i in entries))
+	assert add.add_bulk(db_path, str(ndjson), chunk_size=2) == 6
+	df = query.get_df(db_path, col_entries=[("Animal","id"),("CageStay","cage_id")], join_entries=[("Animal.cage_stays",)])
+	assert df["CageStay_cage_id"].tolist() == [1]*5
+
+	#entries committed in one transaction are still read in batches, rather than all at once
+	monkeypatch.setattr(add, "BULK_BATCH_SIZE", 2)
+	read = []
+	def entries():
+		for i in range(10, 16):
+			read.append(i)
+			yield {"CATEGORY":"Cage","id":i}
+	add_generic = add.add_generic
+	unread = []
+	def counting_add_generic(db_path, parameters, **kwargs):
+		#entries read ahead of the one being added
+		unread.append(len(read) - read.index(parameters["id"]) - 1)
+		return add_generic(db_path, parameters, **kwargs)
+	monkeypatch.setattr(add, "add_generic", counting_add_generic)
+	assert add.add_bulk(db_path, entries()) == 6
+	assert max(unread) < 2
+	monkeypatch.setattr(add, "add_generic", add_generic)
+
+	#a failing entry rolls back its whole chunk, or all batches of a single transaction
+	entries = [{"CATEGORY":"Cage","id":2},{"CATEGORY":"Cage","id":3},{"CATEGORY":"Animal","cage_stays":[{"CATEGORY":"CageStay","cage_id":"Cage:id.4"}]}]
+	capsys.readouterr()
+	with pytest.raises(BaseException):
+		add.add_bulk(db_path, entries)
+	captured = capsys.readouterr()
+	assert "Rolled back" not in captured.out
+	assert "Rolled back all entries after the first 0 entries." in captured.err
+	df = query.get_df(db_path, col_entries=[("Cage","id")])
+	assert df["Cage_id"].tolist() == [1] + list(range(10, 16))
+
+def test_import_entries(tmpdir):
+	from labbookdb.db import query
+
+	db_path = str(tmpdir.join("meta.db"))
+	cages = tmpdir.join("cages.ndjson")
+	cages.write('{"id":1}\n\n{"id":2}\n')
+	assert add.import_entries(db_path, str(cages), category="Cage") == 2
+	animals = tmpdir.join("animals.csv")
+	animals.write("\n".join([
+		'Animal_sex,birth_date,cage_stays,external_ids',
+		'm,"2016,1,2","[{""CATEGORY"":""CageStay"",""start_date"":""2016,4,1"",""cage_id"":""Cage:id.2""}]",',
+		'f,,,"{""CATEGORY"":""AnimalExternalIdentifier"",""database"":""ETH/AIC"",""identifier"":""5001""}"',
+		]))
+	assert add.import_entries(db_path, str(animals), category="Animal", chunk_size=1) == 2
+	df = query.get_df(db_path, col_entries=[("Animal","id"),("Animal","sex"),("CageStay","cage_id")], join_entries=[("Animal.cage_stays",)])
+	assert df[["Animal_id","Animal_sex","CageStay_cage_id"]].values.tolist() == [[1,"m",2]]
+
+	session, engine = add.load_session(db_path)
+	add.resolve_selectors(session, ["Cage:id.1", "Cage:id.2", "Cage:id.3", "TreatmentProtocol:code.aFluIV", "Animal:external_ids.AnimalExternalIdentifier:database.ETH/AIC&#&identifier.5001"])
+	related_ids = session.info[add.RELATED_IDS_KEY]
+	assert related_ids[add.parse_selector("Cage:id.2")][0] == [2]
+	assert add.parse_selector("Cage:id.3") not in related_ids
+	assert add.get_related_ids(session, engine, "Cage:id.1")[0] == [1]
+	session.close()
+
+def test_iter_df(tmpdir):
+	import pandas as pd
+	from labbookdb.db import query
+	from labbookdb.report.utilities import collapse_rename, iter_collapse_rename
+
+	db_path = str(tmpdir.join("meta.db"))
+	entries = [{"CATEGORY":"Animal","sex":"mf"[i%2],"external_ids":[{"CATEGORY":"AnimalExternalIdentifier","database":database,"identifier":str(i)} for database in ["ETH/AIC","UZH/iRATco"][:1+i%2]]} for i in range(7)]
+	add.add_bulk(db_path, entries)
+
+	col_entries = [("Animal","id"),("AnimalExternalIdentifier",)]
+	join_entries = [("Animal.external_ids",)]
+	order_by = ["Animal_id","AnimalExternalIdentifier_database"]
+	df = query.get_df(db_path, col_entries=col_entries, join_entries=join_entries, order_by=order_by)
+	chunks = list(query.iter_df(db_path, col_entries=col_entries, join_entries=join_entries, order_by=order_by, chunksize=3))
+	assert [len(i) for i in chunks] == [3,3,3,1]
+	pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), df)
+	rows = list(query.iter_df(db_path, col_entries=col_entries, join_entries=join_entries, order_by=order_by, rows=True))
+	assert rows == [tuple(i) for i in df.itertuples(index=False)]
+	with pytest.raises(ValueError):
+		query.get_df(db_path, col_entries=col_entries, join_entries=join_entries, order_by=["Animal_sex"])
+
+	collapse = {"AnimalExternalIdentifier_database":lambda x: ", ".join(x)}
+	collapsed = collapse_rename(df, "Animal_id", collapse)
+	assert len(collapsed.index) == 7
+	pd.testing.assert_frame_equal(pd.concat(iter_collapse_rename(chunks, "Animal_id", collapse)), collapsed)
+
+def test_revision(tmpdir):
+	import sqlalchemy
+	from labbookdb.db import query
+
+	db_path = str(tmpdir.join("meta.db"))
+	add.load_session(db_path)[0].close()
+	assert query.revision(db_path) is None
+	assert query.database_id(db_path) is None
+	add.add_generic(db_path, {"CATEGORY":"Genotype","code":"eptg"})
+	add.add_generic(db_path, {"CATEGORY":"Animal","sex":"m","cage_stays":[{"CATEGORY":"CageStay","start_date":"2016,4,1"}]})
+	animals_revision = query.revision(db_path, ["animals","cage_stays"])
+	measurements_revision = query.revision(db_path, ["measurements","weight_measurements"])
+	assert measurements_revision == 0
+
+	#adding measurements to an animal does not change the animal or cage stay tables
+	add.append_parameter(db_path, "Animal:id.1", {"measurements":[{"CATEGORY":"WeightMeasurement","date":"2016,5,1","weight":20.0}]})
+	assert query.revision(db_path, ["animals","cage_stays"]) == animals_revision
+	assert query.revision(db_path, ["measurements","weight_measurements"]) > measurements_revision
+
+	#association tables are tracked as well
+	genotype_revision = query.revision(db_path, ["genotype_associations"])
+	add.append_parameter(db_path, "Animal:id.1", {"genotypes":["Genotype:code.eptg"]})
+	assert query.revision(db_path, ["genotype_associations"]) > genotype_revision
+	assert query.revision(db_path) > query.revision(db_path, ["animals"])
+	#deletions are tracked as well
+	cages_revision = query.revision(db_path, ["cages"])
+	add.add_generic(db_path, {"CATEGORY":"Cage","id":1})
+	assert query.revision(db_path, ["cages"]) > cages_revision
+	cages_revision = query.revision(db_path, ["cages"])
+	session, engine = add.load_session(db_path)
+	session.delete(session.query(add.Cage).one())
+	session.commit()
+	session.close()
+	assert query.revision(db_path, ["cages"]) > cages_revision
+
+	#sessions of other databases and models are not affected
+	from sqlalchemy.ext.declarative import declarative_base
+	OtherBase = declarative_base()
+	class Other(OtherBase):
+		__tablename__ = "others"
+		id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+	other_engine = sqlalchemy.create_engine("sqlite:///" + str(tmpdir.join("other.db")))
+	OtherBase.metadata.create_all(other_engine)
+	other_session = sqlalchemy.orm.Session(bind=other_engine)
+	other_session.add(Other(id=1))
+	other_session.commit()
+	other_session.close()
+
+	#the database identifier is assigned once, and is not counted as a table revision
+	assert query.database_id(db_path) is not None
+	assert query.revision(db_path) == sum(query.revision(db_path, [i]) for i in add.Base.metadata.tables)
+
+def test_add_indexes(tmpdir):
+	import datetime
+	from labbookdb.db import query
+
+	#small database without the secondary indexes (as created by older LabbookDB versions)
+	db_path = str(tmpdir.join("meta.db"))
+	engine = query.get_engine(db_path)
+	animals = 20
+	index_names = sorted(i.name for t in add.Base.metadata.tables.values() for i in t.indexes)
+	with engine.begin() as connection:
+		connection.execute(add.Animal.__table__.insert(), [{"id":i, "sex":"mf"[i%2]} for i in range(1,animals+1)])
+		connection.execute(add.AnimalExternalIdentifier.__table__.insert(), [{"animal_id":i, "database":"ETH/AIC", "identifier":str(i)} for i in range(1,animals+1)])
+		connection.execute(add.Measurement.__table__.insert(), [{"id":i, "animal_id":1+i%animals, "type":"weight", "date":datetime.datetime(2016,1,1)} for i in range(1,5*animals+1)])
+		for index_name in index_names:
+			connection.execute("DROP INDEX {}".format(index_name))
+
+	def plan(statement):
+		with engine.connect() as connection:
+			return str(connection.execute("EXPLAIN QUERY PLAN " + statement).fetchall())
+	identifier_lookup = "SELECT animal_id FROM animal_external_identifiers WHERE database = 'ETH/AIC' AND identifier = '5'"
+	measurement_lookup = "SELECT id FROM measurements WHERE animal_id = 5"
+
+	assert "ix_animal_external_identifiers_database_identifier" not in plan(identifier_lookup)
+	assert "ix_measurements_animal_id" not in plan(measurement_lookup)
+	assert sorted(query.add_indexes(db_path)) == index_names
+	assert query.add_indexes(db_path) == []
+	assert "ix_animal_external_identifiers_database_identifier" in plan(identifier_lookup)
+	assert "ix_measurements_animal_id" in plan(measurement_lookup)
+	query.dispose_engines(db_path)
+
+def test_animal_info(tmpdir, capsys):
+	import json
+	import sqlalchemy
+	from labbookdb.db import query
+
+	db_path = str(tmpdir.join("meta.db"))
+	entries = [
+		{"CATEGORY":"Cage","id":1},
+		{"CATEGORY":"MeasurementUnit","code":"g"},
+		{"CATEGORY":"TreatmentProtocol","code":"aFluIV","name":"Fluoxetine"},
+		{"CATEGORY":"Genotype","code":"eptg","construct":"ePet-cre","zygosity":"tg"},
+		]
+	for i in range(1,4):
+		entries.append({"CATEGORY":"Animal","sex":"m",
+			"external_ids":[{"CATEGORY":"AnimalExternalIdentifier","database":"ETH/AIC","identifier":str(5000+i)}],
+			"genotypes":["Genotype:code.eptg"],
+			"cage_stays":[{"CATEGORY":"CageStay","start_date":"2016,4,{}".format(i),"cage_id":1}],
+			"treatments":[{"CATEGORY":"Treatment","start_date":"2017,1,1","protocol_id":"TreatmentProtocol:code.aFluIV"}],
+			"measurements":[{"CATEGORY":"WeightMeasurement","date":"2017,1,{}".format(i),"weight":24.0+i,"weight_unit_id":"MeasurementUnit:code.g"}],
+			})
+	add.add_bulk(db_path, entries)
+	capsys.readouterr()
+
+	statements = []
+	engine = query.get_engine(db_path, "read-only")
+	def count_statements(*args):
+		statements.append(args)
+	sqlalchemy.event.listen(engine, "before_cursor_execute", count_statements)
+	try:
+		query.animal_info(1, db_path=db_path)
+		single_statements = len(statements)
+		single = capsys.readouterr().out
+		del statements[:]
+		query.animal_info(["3", "1", "7"], db_path=db_path)
+		#the number of queries does not depend on the number of animals
+		assert len(statements) == single_statements
+	finally:
+		sqlalchemy.event.remove(engine, "before_cursor_execute", count_statements)
+	captured = capsys.readouterr()
+	assert captured.out.startswith("Animal(id: 3")
+	assert single in captured.out
+	assert "Weight(2017-01-01 00:00:00, weight: 25.0g)" in single
+	assert "Fluoxetine" in single
+	assert "No entry was found with 7" in captured.err
+
+	query.animal_info(["5002", "5001"], database="ETH/AIC", db_path=db_path, output_format="json")
+	animals = json.loads(capsys.readouterr().out)
+	assert [i["id"] for i in animals] == [2, 1]
+	assert animals[1]["external_ids"][0]["identifier"] == "5001"
+	assert animals[1]["treatments"][0]["protocol"]["name"] == "Fluoxetine"
+	assert animals[1]["measurements"][0]["weight"] == 25.0
+
+	#the external database can also be given after the identifiers, as in `LDB animal-info 5001 ETH/AIC`
+	query.animal_info(["5003", "5001", "ETH/AIC"], db_path=db_path, output_format="json")
+	assert [i["id"] for i in json.loads(capsys.readouterr().out)] == [3, 1]
+	with pytest.raises(ValueError):
+		query.animal_info(["ETH/AIC", "5001"], db_path=db_path)
+
+	query.cage_info(db_path, [1], output_format="json")
+	cages = json.loads(capsys.readouterr().out)
+	assert sorted(i["animals"][0]["external_ids"][0]["identifier"] for i in cages[0]["stays"]) == ["5001", "5002", "5003"]
+	query.dispose_engines(db_path)
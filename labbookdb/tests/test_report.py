@@ -20,6 +20,19 @@ def test_implant_angle_filter():
 
 	assert animals_eth == ['5684']
 
+def test_animal_ids():
+	"""Check if batch identifier resolution matches the resolution of individual identifiers."""
+	from labbookdb.report.selection import animal_id, animal_ids
+
+	db_path=DB_PATH
+	identifiers = ['5684','6255','0']
+	my_ids = animal_ids(db_path, 'ETH/AIC', identifiers)
+	assert list(my_ids.keys()) == identifiers
+	assert my_ids['0'] == 'FailedIDQuery'
+	for identifier in identifiers[:2]:
+		assert my_ids[identifier] == animal_id(db_path, 'ETH/AIC', identifier)
+	assert animal_ids(db_path, 'ETH/AIC', [my_ids['5684']], reverse=True) == {my_ids['5684']:'5684'}
+
 def test_animal_cage_treatment_control_in_report():
 	"""Check if animal which died before the cagetreatment was applied to its last home cage is indeed not showing a cage treatment, but still showing the animal treatment."""
 	from labbookdb.report.tracking import animals_info
@@ -118,3 +131,34 @@ def test_groups():
 	sorted_ids = sorted(df['ETH/AIC'].tolist())
 
 	assert sorted_ids == known_sorted_ids
+
+def test_animal_weights_onset(tmpdir, capsys):
+	from labbookdb.db.add import add_bulk
+	from labbookdb.report.tracking import animal_weights
+
+	db_path = str(tmpdir.join('meta.db'))
+	def animal(identifier, weights, treatments=[]):
+		return {"CATEGORY":"Animal","sex":"m",
+			"external_ids":[{"CATEGORY":"AnimalExternalIdentifier","database":"ETH/AIC","identifier":identifier}],
+			"measurements":[{"CATEGORY":"WeightMeasurement","date":date,"weight":weight} for date, weight in weights],
+			"treatments":[{"CATEGORY":"Treatment","start_date":start_date,"protocol_id":"Protocol:code.aFluIV"} for start_date in treatments],
+			}
+	add_bulk(db_path, [
+		{"CATEGORY":"TreatmentProtocol","code":"aFluIV"},
+		animal("5001", [("2016,5,21",25.),("2016,5,31",26.)], ["2016,5,11","2016,5,1"]),
+		#not treated, and therefore dropped from weights relative to the treatment onset
+		animal("5002", [("2016,5,21",24.)]),
+		])
+	capsys.readouterr()
+
+	assert len(animal_weights(db_path).index) == 3
+	relative_dates = {}
+	for onset in ["earliest", "latest"]:
+		df = animal_weights(db_path, {'animal':['aFluIV']}, onset=onset)
+		assert set(df['Animal_id']) == {1}
+		relative_dates[onset] = sorted(set(df['relative_date'].dt.days))
+	assert relative_dates == {"earliest": [20, 30], "latest": [10, 20]}
+	df = animal_weights(db_path, {'animal':['aFluIV']})
+	assert sorted(set(df['relative_date'].dt.days)) in relative_dates.values()
+	with pytest.raises(ValueError):
+		animal_weights(db_path, {'animal':['aFluIV']}, onset="median")
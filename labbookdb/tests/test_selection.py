@@ -18,3 +18,85 @@ def test_parameterized_animals_base():
 
 	assert info_df['Animal_sex'].item() == 'm'
 	assert info_df['Animal_birth_date'][0] == birth
+
+def test_animal_ids(tmpdir):
+	from labbookdb.db.add import add_generic
+	from labbookdb.report.selection import animal_id, animal_ids, external_id_table
+
+	db_path = str(tmpdir.join('meta.db'))
+	for identifier in ['5001','5002','5003']:
+		add_generic(db_path, {"CATEGORY":"Animal","sex":"m","external_ids":[{"CATEGORY":"AnimalExternalIdentifier","database":"ETH/AIC","identifier":identifier}]})
+	identifiers = ['5001','5003','6000']
+	for cache in [False, True]:
+		my_ids = animal_ids(db_path, 'ETH/AIC', identifiers, cache=cache)
+		assert my_ids == {'5001':1, '5003':3, '6000':'FailedIDQuery'}
+		my_ids = animal_ids(db_path, 'ETH/AIC', [1,'2'], reverse=True, cache=cache)
+		assert my_ids == {1:'5001', '2':'5002'}
+	assert animal_id(db_path, 'ETH/AIC', '5002') == 2
+
+	#the lookup table is refreshed once external identifiers change
+	add_generic(db_path, {"CATEGORY":"Animal","sex":"f","external_ids":[{"CATEGORY":"AnimalExternalIdentifier","database":"ETH/AIC","identifier":"6000"}]})
+	assert animal_ids(db_path, 'ETH/AIC', ['6000'], cache=True) == {'6000':4}
+	assert external_id_table(db_path, 'ETH/AIC')[1]['4'] == ['6000']
+
+def test_parameterized_cache(tmpdir):
+	import pandas as pd
+	from labbookdb.db.add import add_generic
+	from labbookdb.report.selection import parameterized
+
+	db_path = str(tmpdir.join('meta.db'))
+	add_generic(db_path, {"CATEGORY":"Animal","sex":"m","birth_date":"2016,7,21","external_ids":[{"CATEGORY":"AnimalExternalIdentifier","database":"ETH/AIC","identifier":"5001"}]})
+	df = parameterized(db_path, 'animals id')
+	pd.testing.assert_frame_equal(parameterized(db_path, 'animals id', cache=True), df)
+	pd.testing.assert_frame_equal(parameterized(db_path, 'animals id', cache=True), df)
+	add_generic(db_path, {"CATEGORY":"Animal","sex":"f","external_ids":[{"CATEGORY":"AnimalExternalIdentifier","database":"ETH/AIC","identifier":"5002"}]})
+	assert len(parameterized(db_path, 'animals id', cache=True).index) == 2
+	assert len(parameterized(db_path, 'animals id', animal_filter=[1], cache=True).index) == 1
+
+def test_select_animals(tmpdir, capsys):
+	import pandas as pd
+	from labbookdb.db.add import add_bulk
+	from labbookdb.report.selection import animal_treatments, select_animals
+
+	db_path = str(tmpdir.join('meta.db'))
+	def animal(stays, operations=[], genotypes=["Genotype:code.eptg"], external_ids=[], **columns):
+		entry = {"CATEGORY":"Animal","sex":"m","genotypes":genotypes,
+			"cage_stays":[{"CATEGORY":"CageStay","start_date":start_date,"cage_id":cage_id} for cage_id, start_date in stays],
+			"operations":[{"CATEGORY":"Operation","date":"2016,3,1","protocols":["Protocol:code."+i for i in protocols]} for protocols in operations],
+			"external_ids":[{"CATEGORY":"AnimalExternalIdentifier","database":"ETH/AIC","identifier":i} for i in external_ids],
+			}
+		entry.update(columns)
+		return entry
+	add_bulk(db_path, [
+		{"CATEGORY":"OrthogonalStereotacticTarget","code":"dr_impl"},
+		{"CATEGORY":"OrthogonalStereotacticTarget","code":"dr_skull"},
+		{"CATEGORY":"OpticFiberImplantProtocol","code":"impl","stereotactic_target_id":"OrthogonalStereotacticTarget:code.dr_impl"},
+		{"CATEGORY":"VirusInjectionProtocol","code":"vi","stereotactic_target_id":"OrthogonalStereotacticTarget:code.dr_skull"},
+		{"CATEGORY":"TreatmentProtocol","code":"cFluDW"},
+		{"CATEGORY":"Genotype","code":"eptg"},
+		{"CATEGORY":"Cage","id":1,"treatments":[{"CATEGORY":"Treatment","start_date":"2016,5,1","protocol_id":"Protocol:code.cFluDW"}]},
+		{"CATEGORY":"Cage","id":2},
+		#treated twice, the treatment onset is only checked for the first treatment, as in `animal_treatments()`
+		{"CATEGORY":"Cage","id":3,"treatments":[
+			{"CATEGORY":"Treatment","start_date":"2016,1,1","protocol_id":"Protocol:code.cFluDW"},
+			{"CATEGORY":"Treatment","start_date":"2016,5,1","protocol_id":"Protocol:code.cFluDW"},
+			]},
+		animal([(1,"2016,4,1")], [["impl","vi"]], external_ids=["5001"]),
+		#moved out of the treated cage before the treatment
+		animal([(1,"2016,4,1"),(2,"2016,4,15")], [["impl"]], external_ids=["5002"]),
+		#moved into the treated cage after the treatment onset, and operated on twice
+		animal([(2,"2016,3,1"),(1,"2016,6,1")], [["impl"],["vi"]], genotypes=[]),
+		#died before the treatment
+		animal([(1,"2016,4,1")], [["impl"]], death_date="2016,4,20"),
+		animal([(3,"2016,4,1")], genotypes=[]),
+		])
+	capsys.readouterr()
+
+	assert select_animals(db_path, implant_targets=['dr_impl'], genotypes=['eptg']) == [1,2,4]
+	assert select_animals(db_path, implant_targets=['dr_impl'], virus_targets=['dr_skull']) == [1,3]
+	assert select_animals(db_path, implant_targets=['dr_impl'], virus_targets=['dr_skull'], genotypes=['eptg']) == [1]
+	assert select_animals(db_path, cage_treatments=['cFluDW']) == [1]
+	assert select_animals(db_path, cage_treatments=['cFluDW']) == sorted(animal_treatments(db_path, cage_treatments=['cFluDW'])['Animal_id'].unique())
+	pd.testing.assert_frame_equal(animal_treatments(db_path, concurrent=True), animal_treatments(db_path))
+	assert select_animals(db_path, implant_targets=['dr_impl'], genotypes=['eptg'], external_id='ETH/AIC') == ['5001','5002','FailedIDQuery']
+	assert select_animals(db_path) == [1,2,3,4,5]
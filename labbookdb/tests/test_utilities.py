@@ -0,0 +1,326 @@
+import pytest
+import time
+
+import numpy as np
+import pandas as pd
+
+def synthetic_cagestays(animals,
+	stays=3,
+	seed=0,
+	):
+	"""Create a `pandas.DataFrame` object formatted like the "cage list" selection, with shuffled rows and some duplicate cage stay start dates."""
+	rng = np.random.RandomState(seed)
+	rows = []
+	for animal in range(1, animals+1):
+		death_date = pd.Timestamp('2017-01-01') + pd.Timedelta(days=int(rng.randint(0,100))) if animal%3 else pd.NaT
+		start_dates = pd.Timestamp('2016-01-01') + pd.to_timedelta(np.sort(rng.randint(0,300,stays)), unit='D')
+		for start_date in start_dates:
+			rows.append([animal, death_date, start_date, int(rng.randint(1,animals//2+2))])
+	df = pd.DataFrame(rows, columns=['Animal_id','Animal_death_date','CageStay_start_date','Cage_id'])
+	return df.sample(frac=1, random_state=seed)
+
+def reference_cagestay_end_dates(df):
+	"""Per-row implementation of `labbookdb.report.utilities.cagestay_end_dates()`, against which the vectorized implementation is checked."""
+	df = df.copy()
+	df['CageStay_end_date'] = ''
+	for subject in df['Animal_id'].unique():
+		for start_date in df[df['Animal_id']==subject]['CageStay_start_date'].tolist():
+			possible_end_dates = df[(df['Animal_id']==subject)&(df['CageStay_start_date']>start_date)]['CageStay_start_date'].tolist()
+			try:
+				end_date = min(possible_end_dates)
+			except ValueError:
+				end_date = None
+			if not end_date:
+				end_date = df[df['Animal_id']==subject]['Animal_death_date'].tolist()[0]
+			df.loc[(df['Animal_id']==subject)&(df['CageStay_start_date']==start_date),'CageStay_end_date'] = end_date
+	return pd.to_datetime(df['CageStay_end_date'])
+
+def test_cagestay_end_dates():
+	from labbookdb.report.utilities import cagestay_end_dates
+
+	df = synthetic_cagestays(60)
+	#duplicate start dates occur e.g. for stays which are joined with multiple cage treatments
+	df = pd.concat([df, df.iloc[:10]])
+	end_dates = cagestay_end_dates(df)
+	assert end_dates.index.equals(df.index)
+	assert end_dates.equals(reference_cagestay_end_dates(df))
+
+@pytest.mark.benchmark
+def test_cagestay_end_dates_benchmark():
+	from labbookdb.report.utilities import cagestay_end_dates
+
+	df = synthetic_cagestays(5000, stays=4)
+	start = time.time()
+	cagestay_end_dates(df)
+	assert time.time() - start < 1
+
+def synthetic_cagetreatments(animals,
+	seed=0,
+	):
+	"""Create `pandas.DataFrame` objects formatted like the "animal treatments" selection and the cage periods thereof, with one or two cage treatments per cage stay."""
+	from labbookdb.report.utilities import cagestay_end_dates
+
+	rng = np.random.RandomState(seed)
+	df = synthetic_cagestays(animals, stays=2, seed=seed)
+	#some animals only have one cage stay
+	df = df.drop(df[(df['Animal_id']%5==0)].drop_duplicates(subset='Animal_id').index)
+	df['TreatmentProtocol_code'] = [None if i%2 else 'aFluIV' for i in df['Animal_id']]
+	df['Cage_Treatment_start_date'] = pd.Timestamp('2016-01-01') + pd.to_timedelta(rng.randint(0,400,len(df)), unit='D')
+	df.loc[rng.rand(len(df)) < 0.2, 'Cage_Treatment_start_date'] = pd.NaT
+	df['Cage_Treatment_end_date'] = None
+	df['Cage_Treatment_protocol_id'] = 2
+	df['Cage_TreatmentProtocol_code'] = 'cFluDW'
+	cagestays = df[['Animal_id','Animal_death_date','CageStay_start_date']].copy()
+	#a second treatment of some cages, in rows which follow the first treatment rows
+	second = df[df['Animal_id']%3==1].copy()
+	second['Cage_Treatment_start_date'] = pd.Timestamp('2016-01-01') + pd.to_timedelta(rng.randint(0,400,len(second)), unit='D')
+	second['Cage_TreatmentProtocol_code'] = 'cFluIV'
+	df = pd.concat([df, second], ignore_index=True)
+	cagestays['CageStay_end_date'] = cagestay_end_dates(cagestays)
+	return df, cagestays
+
+def reference_concurrent_cagetreatment(df, cagestays):
+	"""Per-animal implementation of `labbookdb.report.utilities.concurrent_cagetreatment()` (as it was before vectorization), against which the vectorized implementation is checked."""
+	df = df.copy()
+	drop_idx = []
+	for subject in list(df['Animal_id'].unique()):
+		stay_starts = df[df['Animal_id']==subject]['CageStay_start_date'].tolist()
+		blank_cells_only = False
+		if len(stay_starts) == 1:
+			if df.loc[df['Animal_id']==subject, 'TreatmentProtocol_code'].item() != None:
+				blank_cells_only = True
+		for stay_start in stay_starts:
+			stay_end = cagestays[(cagestays['Animal_id']==subject)&(cagestays['CageStay_start_date']==stay_start)]['CageStay_end_date'].tolist()[0]
+			treatment_start = df[(df['Animal_id']==subject)&(df['CageStay_start_date']==stay_start)]['Cage_Treatment_start_date'].tolist()[0]
+			death_date = df[df['Animal_id']==subject]['Animal_death_date'].tolist()[0]
+			if treatment_start <= stay_start or treatment_start >= stay_end or treatment_start >= death_date:
+				if blank_cells_only:
+					df.loc[df['Animal_id']==subject, ['Cage_TreatmentProtocol_code', 'Cage_Treatment_start_date', 'Cage_Treatment_end_date', 'Cage_Treatment_protocol_id']] = None
+				else:
+					drop_idx.extend(df[(df['Animal_id']==subject)&(df['CageStay_start_date']==stay_start)].index.tolist())
+	return df.drop(drop_idx)
+
+def test_concurrent_cagetreatment():
+	from labbookdb.report.utilities import concurrent_cagetreatment
+
+	df, cagestays = synthetic_cagetreatments(100)
+	concurrent_df = concurrent_cagetreatment(df, cagestays)
+	reference_df = reference_concurrent_cagetreatment(df, cagestays)
+	pd.testing.assert_frame_equal(concurrent_df, reference_df)
+
+	assert len(concurrent_df.index) < len(df.index)
+	assert concurrent_df['Cage_TreatmentProtocol_code'].isnull().any()
+
+	#the first treatment of a cage stay decides whether all rows of the stay are kept
+	stay = cagestays.dropna(subset=['CageStay_end_date']).iloc[[0]]
+	df = df.merge(stay[['Animal_id','CageStay_start_date']]).iloc[[0]]
+	df = pd.concat([df, df], ignore_index=True)
+	concurrent_start = stay['CageStay_start_date'].iloc[0] + (stay['CageStay_end_date'].iloc[0] - stay['CageStay_start_date'].iloc[0])/2
+	df['Cage_Treatment_start_date'] = [concurrent_start, pd.Timestamp('1970-01-01')]
+	assert len(concurrent_cagetreatment(df, cagestays).index) == 2
+	df['Cage_Treatment_start_date'] = [pd.Timestamp('1970-01-01'), concurrent_start]
+	assert concurrent_cagetreatment(df, cagestays).empty
+
+@pytest.mark.benchmark
+def test_concurrent_cagetreatment_benchmark():
+	from labbookdb.report.utilities import concurrent_cagetreatment
+
+	df, cagestays = synthetic_cagetreatments(5000)
+	start = time.time()
+	concurrent_cagetreatment(df, cagestays)
+	assert time.time() - start < 1
+
+def reference_occupancy(cagestays, measurements):
+	"""Per-measurement implementation of `labbookdb.report.utilities.CageOccupancy.occupancy()`, against which the batch implementation is checked."""
+	occupancy = []
+	for cage_id, start_date, end_date in measurements[['Cage_id','start_date','end_date']].itertuples(index=False):
+		occupants = cagestays[
+				(cagestays['CageStay_start_date']<=start_date)&
+				(
+					(cagestays['CageStay_end_date']>=end_date)|
+					(cagestays['CageStay_end_date'].isnull())
+				)&
+				(cagestays['Cage_id']==cage_id)
+				]
+		occupancy.append(len(occupants.index))
+	return occupancy
+
+def synthetic_measurements(cagestays, measurements,
+	seed=0,
+	):
+	"""Create a `pandas.DataFrame` object of per-cage measurement periods."""
+	rng = np.random.RandomState(seed)
+	start_dates = pd.Timestamp('2016-01-01') + pd.to_timedelta(rng.randint(0,450,measurements), unit='D')
+	df = pd.DataFrame({
+		'Cage_id':rng.choice(cagestays['Cage_id'].unique(), measurements),
+		'start_date':start_dates,
+		'end_date':start_dates + pd.to_timedelta(rng.randint(1,10,measurements), unit='D'),
+		})
+	df.loc[rng.rand(measurements) < 0.05, 'start_date'] = pd.NaT
+	return df
+
+def test_cage_occupancy():
+	from labbookdb.report.utilities import cagestay_end_dates, CageOccupancy
+
+	cagestays = synthetic_cagestays(100, seed=1).drop_duplicates(subset=['Animal_id','Cage_id'])
+	cagestays['CageStay_end_date'] = cagestay_end_dates(cagestays)
+	measurements = synthetic_measurements(cagestays, 500)
+	occupancy = CageOccupancy(cagestays)
+	assert occupancy.occupancy(measurements['Cage_id'], measurements['start_date'], measurements['end_date']).tolist() == reference_occupancy(cagestays, measurements)
+
+	cage_id, start_date, end_date = measurements.dropna().iloc[0]
+	occupants = occupancy.occupants(cage_id, start_date, end_date)
+	assert len(occupants.index) == reference_occupancy(cagestays, measurements.dropna().iloc[[0]])[0]
+	assert (occupants['Cage_id'] == cage_id).all()
+	assert len(occupancy.occupants(-1, start_date, end_date).index) == 0
+
+	#an animal with two stays covering the same period is an error
+	stay = cagestays.iloc[[0]].copy()
+	stay['CageStay_end_date'] = pd.NaT
+	occupancy = CageOccupancy(pd.concat([cagestays, stay], ignore_index=True))
+	with pytest.raises(ValueError):
+		occupancy.occupancy(stay['Cage_id'], stay['CageStay_start_date'], stay['CageStay_start_date'])
+
+@pytest.mark.benchmark
+def test_cage_occupancy_benchmark():
+	from labbookdb.report.utilities import cagestay_end_dates, CageOccupancy
+
+	cagestays = synthetic_cagestays(5000, stays=4).drop_duplicates(subset=['Animal_id','Cage_id'])
+	cagestays['CageStay_end_date'] = cagestay_end_dates(cagestays)
+	measurements = synthetic_measurements(cagestays, 20000)
+	start = time.time()
+	CageOccupancy(cagestays).occupancy(measurements['Cage_id'], measurements['start_date'], measurements['end_date'])
+	assert time.time() - start < 1
+
+def test_cached_result(tmpdir):
+	import os
+	pytest.importorskip('pyarrow')
+	from labbookdb.db import query
+	from labbookdb.db.add import add_generic
+	from labbookdb.report.utilities import cached_result, RESULT_CACHE_SUFFIX
+
+	db_path = str(tmpdir.join('meta.db'))
+	add_generic(db_path, {"CATEGORY":"Animal","sex":"m"})
+	computed = []
+	def compute():
+		computed.append(1)
+		return pd.DataFrame({'Animal_id':[1,2], 'Animal_death_date':pd.to_datetime(['2017-01-01',None])})
+	df = cached_result(db_path, ['animals', [1,2]], compute, table_names=['animals'])
+	pd.testing.assert_frame_equal(cached_result(db_path, ['animals', [1,2]], compute, table_names=['animals']), df)
+	assert len(computed) == 1
+	cached_result(db_path, ['animals', [1]], compute, table_names=['animals'])
+	assert len(computed) == 2
+
+	#changes to other tables do not invalidate the cached results
+	add_generic(db_path, {"CATEGORY":"Cage","id":1})
+	cached_result(db_path, ['animals', [1,2]], compute, table_names=['animals'])
+	assert len(computed) == 2
+
+	#changes to the tracked tables invalidate and replace the cached results
+	add_generic(db_path, {"CATEGORY":"Animal","sex":"f"})
+	cached_result(db_path, ['animals', [1,2]], compute, table_names=['animals'])
+	assert len(computed) == 3
+	assert len(os.listdir(db_path+RESULT_CACHE_SUFFIX)) == 2
+
+	#a database recreated under the same path with the same revisions does not reuse the cached results
+	query.dispose_engines(db_path)
+	for suffix in ['', '-wal', '-shm']:
+		if os.path.exists(db_path+suffix):
+			os.remove(db_path+suffix)
+	add_generic(db_path, {"CATEGORY":"Animal","sex":"m"})
+	add_generic(db_path, {"CATEGORY":"Cage","id":1})
+	add_generic(db_path, {"CATEGORY":"Animal","sex":"f"})
+	cached_result(db_path, ['animals', [1,2]], compute, table_names=['animals'])
+	assert len(computed) == 4
+
+	#results which cannot be stored are returned uncached
+	mixed = cached_result(db_path, ['mixed'], lambda: pd.DataFrame({'a':[1,'b']}))
+	assert mixed['a'].tolist() == [1,'b']
+	assert len(os.listdir(db_path+RESULT_CACHE_SUFFIX)) == 2
+	blocked_path = str(tmpdir.join('blocked.db'))
+	add_generic(blocked_path, {"CATEGORY":"Animal","sex":"m"})
+	with open(blocked_path+RESULT_CACHE_SUFFIX, 'w') as f:
+		f.write('notes')
+	pd.testing.assert_frame_equal(cached_result(blocked_path, ['animals', [1,2]], compute, table_names=['animals']), df)
+	cached_result(blocked_path, ['animals', [1,2]], compute, table_names=['animals'])
+	assert len(computed) == 6
+	query.dispose_engines(db_path)
+	query.dispose_engines(blocked_path)
+
+def test_run_selections():
+	import threading
+	from labbookdb.report.utilities import run_selections
+
+	#both selections have to be running at the same time for either of them to finish
+	barrier = threading.Barrier(2, timeout=10)
+	selections = {
+		'a': lambda: (barrier.wait(), 'a')[1],
+		'b': lambda: (barrier.wait(), threading.get_ident())[1],
+		}
+	results = run_selections(selections, concurrent=True)
+	assert results['a'] == 'a'
+	assert results['b'] != threading.get_ident()
+	assert run_selections({'a': threading.get_ident}) == {'a': threading.get_ident()}
+
+	def fail():
+		raise ValueError
+	with pytest.raises(ValueError):
+		run_selections({'a': lambda: 'a', 'b': fail}, concurrent=True)
+
+def synthetic_collapse(groups,
+	seed=0,
+	):
+	"""Create a long form `pandas.DataFrame` object with several rows per group, including missing and empty values, conflicting values, and timestamps."""
+	rng = np.random.RandomState(seed)
+	size = groups*4
+	df = pd.DataFrame({
+		'group': rng.randint(0, groups, size),
+		'code': rng.choice(['a', 'b', 'c', '', None], size),
+		'date': pd.Timestamp('2016-01-01') + pd.to_timedelta(rng.randint(0, 2, size), unit='D'),
+		'weight': rng.randint(0, 2, size).astype(float),
+		})
+	#groups with a single row cannot have conflicting values
+	df.loc[df['group']%3 == 0, 'weight'] = 1.
+	return df
+
+def test_collapse_operations():
+	from labbookdb.report.utilities import CONFLICT_WARNING, any_contains, collapse_rename, count_where, first_unique, unique_join
+
+	df = synthetic_collapse(200)
+	#the lambda functions which the collapse operations replace
+	reference_collapse = {
+		'code': lambda x: ', '.join(sorted(set([str(i) for i in x if i]))),
+		'date': lambda x: list(set(x))[0] if (len(set(x)) == 1) else CONFLICT_WARNING,
+		'weight': lambda x: list(set(x))[0] if (len(set(x)) == 1) else CONFLICT_WARNING,
+		}
+	reference = collapse_rename(df, 'group', reference_collapse)
+	collapse = {
+		'code': unique_join(skip_empty=True),
+		'date': first_unique(),
+		'weight': first_unique(),
+		}
+	collapsed = collapse_rename(df, 'group', collapse)
+	collapsed['code'] = collapsed['code'].map(lambda x: ', '.join(sorted(x.split(', '))) if x else x)
+	pd.testing.assert_frame_equal(collapsed, reference)
+	#collapse operations can also be called once per group, like lambda functions
+	pd.testing.assert_frame_equal(df.groupby('group').agg(collapse), collapse_rename(df, 'group', collapse))
+
+	counted = collapse_rename(df, 'group', {'code': count_where('a'), 'weight': any_contains(0.), 'date': count_where()}, {'date': 'rows'})
+	assert counted['code'].tolist() == df.groupby('group')['code'].agg(lambda x: list(x).count('a')).tolist()
+	assert counted['weight'].tolist() == df.groupby('group')['weight'].agg(lambda x: 1 if 0. in list(x) else 0).tolist()
+	assert counted['rows'].tolist() == df.groupby('group').size().tolist()
+
+	#values are joined in the order of their first occurrence, and datetimes are formatted as by `str()`
+	df = pd.DataFrame({'group': [1, 1, 1, 2], 'code': ['b', 'a', 'b', None], 'date': pd.to_datetime(['2016-07-21']*4)})
+	collapsed = collapse_rename(df, 'group', {'code': unique_join(skip_empty=True), 'date': unique_join()})
+	assert collapsed['code'].tolist() == ['b, a', '']
+	assert collapsed['date'].tolist() == ['2016-07-21 00:00:00']*2
+
+@pytest.mark.benchmark
+def test_collapse_operations_benchmark():
+	from labbookdb.report.utilities import collapse_rename, first_unique, unique_join
+
+	df = synthetic_collapse(50000)
+	start = time.time()
+	collapse_rename(df, 'group', {'code': unique_join(skip_empty=True), 'date': first_unique(), 'weight': first_unique()})
+	assert time.time() - start < 1
@@ -23,6 +23,9 @@ if __name__ == '__main__':
 			],
 		classifiers = [],
 		install_requires = [],
+		extras_require = {
+			"cache": ["pyarrow"],
+			},
 		provides = ["labbookdb"],
 		packages = [
 			"labbookdb",